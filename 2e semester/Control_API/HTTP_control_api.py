@@ -1,17 +1,44 @@
 import json
 import requests
-from time import sleep
+import threading
+from math import pi
+from time import monotonic, sleep
 import logging
 import os
 import colorlog
+from uuid import uuid4
+from .endpoint_resolver import EndpointResolver
+from PythonServer_Package.logging_setup import remove_handlers
+from PythonServer_Package.robot_object import trapezoid_duration
 
 class RobotControlAPI:
-    def __init__(self, server_url = "http://10.0.1.250", loopback:bool=True, log_files_path:str = "C:/Users/Sybe/Documents/!UAntwerpen/6e Semester/6 - Bachelorproef/Code/Github/6-BachelorProef_FTI-EM_CoSysLab/2e semester/PythonServer_Package/logs", loopback_adress:str = "http://127.0.0.1"):
+    def __init__(self, server_url = "http://10.0.1.250", loopback:bool=True, log_files_path:str = "C:/Users/Sybe/Documents/!UAntwerpen/6e Semester/6 - Bachelorproef/Code/Github/6-BachelorProef_FTI-EM_CoSysLab/2e semester/PythonServer_Package/logs", loopback_adress:str = "http://127.0.0.1", request_timeout: float = 5, max_retries: int = 3, retry_backoff: float = 0.5, endpoints: list[str] | None = None, probe_timeout: float = 3, health_ttl: float = 30):
         self.server_url = server_url
         self.loopback_adress = loopback_adress
         self.loopback = loopback
         self.connected = False
         self.HEADERSIZE = 10
+        self.client_id = uuid4().hex # Lets the server schedule clients fairly
+
+        # Mutating commands carry an idempotency key, so they can be retried with short timeouts
+        self.request_timeout = request_timeout #s, on top of the expected motion time
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff #s, doubled on every retry
+        self.queue_wait = 0.0 #s, the server's last estimate of its queue, added to the timeouts
+        self.max_in_progress_wait = 600 #s a command the server reports as running is waited for
+        # Motion parameters for the timeouts, RobotObject defaults until the server reports its own
+        self.steps_per_ul = 200 * 8 / (1 * (4/2)**2 * pi)
+        self.acceleration = 1000 #steps/s^2
+        self.post_endpoints = ["aspirate","dispense","set_parameters","set_safe_bounds","set_calibration_offset","set_telemetry","load_calibration","upload_program"]
+        self.mutating_endpoints = self.post_endpoints + ["eject_tip","zero_robot","run_program"]
+        self.post_endpoints = self.post_endpoints + ["lease/acquire","lease/heartbeat","lease/release"]
+
+        # Exclusive use of the robot for a whole protocol, renewed by a heartbeat thread
+        self.lease_token: str | None = None
+        self.lease_duration = 30 #s
+        self.heartbeat_thread = None
+
+        self.program_duration = 0.0 #s, the server's estimate for the uploaded program
 
         # Initialize client variables
         self.client_socket = None
@@ -21,9 +48,11 @@ class RobotControlAPI:
 
         self.setup_logging(log_files_path=log_files_path)
 
+        # Primary, loopback and any extra endpoints are probed concurrently
+        candidates = [server_url] + ([loopback_adress] if loopback else []) + (endpoints or [])
+        self.resolver = EndpointResolver(candidates, probe_timeout=probe_timeout, ttl=health_ttl)
+
         self.check_server_availability()
-        
-        sleep(0.1)
 
     def setup_logging(self,log_files_path:str):
         log_file_path_http_client = os.path.abspath(f"{log_files_path}/http_client.log")  # Relative path
@@ -58,6 +87,7 @@ class RobotControlAPI:
         file_handler_common_http_client.setFormatter(file_formatter_http_client)
 
         self.logger_http_client = logging.getLogger("HTTP Client")
+        remove_handlers(self.logger_http_client)
         self.logger_http_client.setLevel(logging.INFO)
         self.logger_http_client.addHandler(console_handler_http_client)
         self.logger_http_client.addHandler(file_handler_http_client)
@@ -68,36 +98,21 @@ class RobotControlAPI:
         self.logger_http_client.info(f"HTTP Client logging initialized. Logs are saved at: {log_files_path}")
  
     def check_server_availability(self):
-        try:
-            # Attempting to ping the server to check availability
-            response = requests.get(f"{self.server_url}/ping",timeout=3)
-            if response.status_code == 200:
-                self.connected = True
-                self.logger_http_client.info(f"Client has connected to {self.server_url}")
-            else:
-                self.connected = False
-                self.logger_http_client.warning(f"Client failed to connect to {self.server_url}.")
-            return self.connected
-        
-        except requests.exceptions.RequestException as e:
-            if self.loopback:
-                self.logger_http_client.warning(f"Looping back to {self.loopback_adress} because {self.server_url} did not respond")
-                try:
-                    response = requests.get(f"{self.loopback_adress}/ping",timeout=3)
-                    if response.status_code == 200:
-                        self.server_url = self.loopback_adress
-                        self.connected = True
-                        self.logger_http_client.info(f"Client has connected to {self.server_url}")
-                        return self.connected
-                except:
-                    self.connected = False
-                    self.logger_http_client.warning("Client failed to connect.")
-                    return False
+        server_url = self.resolver.resolve()
+        if server_url is None:
             self.connected = False
-            self.logger_http_client.warning("Client failed to connect.")
+            self.logger_http_client.warning(f"Client failed to connect, none of {self.resolver.candidates} responded.")
             return False
 
-    def aspirate(self, volume_in_ul: int, rate_in_ul_per_s:int) -> dict[str,str]:
+        if server_url != self.server_url or not self.connected:
+            if server_url != self.server_url:
+                self.logger_http_client.warning(f"Switching from {self.server_url} to {server_url}")
+            self.server_url = server_url
+            self.logger_http_client.info(f"Client has connected to {self.server_url}")
+        self.connected = True
+        return True
+
+    def aspirate(self, volume_in_ul: int | list[int], rate_in_ul_per_s: int | list[int]) -> dict[str,str]:
         """Sends an aspirate command."""
         self.logger_http_client.info(f"Sending aspirate command: {volume_in_ul} ul at {rate_in_ul_per_s} ul/s")
         if not self.connected:
@@ -111,9 +126,9 @@ class RobotControlAPI:
 
         command_str = json.dumps(command)
         
-        return self.send_message(command_str,"aspirate")
+        return self.send_message(command_str,"aspirate",expected_duration=self.expected_duration(volume_in_ul, rate_in_ul_per_s))
 
-    def dispense(self, volume_in_ul: int, rate_in_ul_per_s:int):
+    def dispense(self, volume_in_ul: int | list[int], rate_in_ul_per_s: int | list[int]):
         """Sends an aspirate command."""
         self.logger_http_client.info(f"Sending dispense command: {volume_in_ul} ul at {rate_in_ul_per_s} ul/s")
         if not self.connected:
@@ -126,9 +141,19 @@ class RobotControlAPI:
         }
 
         command_str = json.dumps(command)
-        self.send_message(command_str,"dispense")
+        self.send_message(command_str,"dispense",expected_duration=self.expected_duration(volume_in_ul, rate_in_ul_per_s))
         return{"status": "success", "message": f"Dispense command sent: {volume_in_ul} ul at {rate_in_ul_per_s} ul/s"}
 
+    def expected_duration(self, volume_in_ul: int | list[int], rate_in_ul_per_s: int | list[int]) -> float:
+        # Lists are per channel, the slowest channel sets the duration. Same trapezoid profile as the server's estimate
+        volumes = volume_in_ul if isinstance(volume_in_ul, list) else [volume_in_ul]
+        rates = rate_in_ul_per_s if isinstance(rate_in_ul_per_s, list) else [rate_in_ul_per_s] * len(volumes)
+        if len(volumes) == 1:
+            volumes = volumes * len(rates)
+        distances = [volume * self.steps_per_ul for volume in volumes] #steps
+        speeds = [rate * self.steps_per_ul for rate in rates]           #steps/s
+        return max(trapezoid_duration(distances, speeds, self.acceleration).tolist(), default=0)
+
     def eject_tip(self):
         """Sends an eject tip command."""
         self.logger_http_client.info("Ejecting tip")
@@ -213,6 +238,125 @@ class RobotControlAPI:
         return {"status": "success", "message": f"Offset set to {offset} ul"}
 
 
+    def upload_program(self, steps: list):
+        """Uploads a protocol, e.g. [["aspirate", 100, 50], ["wait", 1], ["dispense", 100, 50]], to run on the device."""
+        if not self.connected:
+            self.logger_http_client.error("Request failed: Not connected to server")
+            return {"status": "error", "message": "Not connected to server"}
+
+        self.logger_http_client.info(f"Uploading program of {len(steps)} steps")
+
+        response = self.send_message(json.dumps({
+            "steps": steps
+            }),"upload_program")
+        self.program_duration = float(response.get("expected_duration", 0))
+        return response
+
+    def run_program(self, expected_duration: float | None = None):
+        """Runs the uploaded program, returns when the device has finished it."""
+        if not self.connected:
+            self.logger_http_client.error("Request failed: Not connected to server")
+            return {"status": "error", "message": "Not connected to server"}
+
+        self.logger_http_client.info("Running uploaded program")
+
+        if expected_duration is None:
+            expected_duration = self.program_duration
+        return self.send_message(json.dumps({"type": "run_program"}),"run_program",expected_duration=expected_duration)
+
+    def load_calibration(self, version: int | None = None):
+        """Loads a calibration profile on the server, the latest one when no version is given."""
+        if not self.connected:
+            self.logger_http_client.error("Request failed: Not connected to server")
+            return {"status": "error", "message": "Not connected to server"}
+
+        self.logger_http_client.info(f"Loading calibration profile {version if version is not None else 'latest'}")
+
+        return self.send_message(json.dumps({
+            "version": version
+            }),"load_calibration")
+
+    def set_telemetry_interval(self, interval_ms: int):
+        if not self.connected:
+            self.logger_http_client.error("Request failed: Not connected to server")
+            return {"status": "error", "message": "Not connected to server"}
+        
+        self.logger_http_client.info(f"Changing telemetry interval to {interval_ms}ms")
+
+        return self.send_message(json.dumps({
+            "interval_ms": interval_ms
+            }),"set_telemetry")
+
+    def get_telemetry(self):
+        """Requests the motion telemetry collected by the server."""
+        if not self.connected:
+            self.logger_http_client.error("Request failed: Not connected to server")
+            return {"status": "error", "message": "Not connected to server"}
+
+        return self.send_message(json.dumps({"type": "telemetry"}),"telemetry")
+
+    def get_queue_status(self):
+        """Requests the depth and rejection counters of the server's command queue."""
+        if not self.connected:
+            self.logger_http_client.error("Request failed: Not connected to server")
+            return {"status": "error", "message": "Not connected to server"}
+
+        return self.send_message(json.dumps({"type": "queue_status"}),"queue_status")
+
+    def acquire_lease(self, duration: float = 30, timeout: float | None = None):
+        """Waits in line for exclusive use of the robot, the lease is renewed in the background until released."""
+        if not self.connected:
+            self.logger_http_client.error("Request failed: Not connected to server")
+            return {"status": "error", "message": "Not connected to server"}
+
+        self.logger_http_client.info(f"Acquiring a {duration}s lease")
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            # The server holds the request while the client is in line, polling keeps its place
+            wait = 10 if deadline is None else max(min(deadline - monotonic(), 10), 0)
+            polled_at = monotonic()
+            response = self.send_message(json.dumps({"duration": duration, "wait": wait}),"lease/acquire",expected_duration=wait)
+            if "token" in response:
+                self.lease_token = response["token"]
+                self.lease_duration = duration
+                if self.heartbeat_thread is None or not self.heartbeat_thread.is_alive():
+                    self.heartbeat_thread = threading.Thread(target=self.send_heartbeats, name="LeaseHeartbeat", daemon=True)
+                    self.heartbeat_thread.start()
+                return response
+            if "position" not in response or (deadline is not None and monotonic() >= deadline):
+                return response
+            if monotonic() - polled_at < min(wait, 1):
+                # The server had no thread to park the poll on, it answered right away
+                sleep(1)
+
+    def release_lease(self):
+        """Hands the robot to the next client in line."""
+        if self.lease_token is None:
+            return {"status": "error", "message": "No lease held"}
+        response = self.send_message(json.dumps({"type": "release"}),"lease/release")
+        self.lease_token = None
+        return response
+
+    def send_heartbeats(self):
+        """Renews the lease well before it expires, stops when the lease is released or lost."""
+        while self.connected and self.lease_token is not None:
+            sleep(self.lease_duration / 3)
+            token = self.lease_token
+            if token is None:
+                break
+            response = self.send_message(json.dumps({"duration": self.lease_duration}),"lease/heartbeat")
+            if response.get("status") == "Error" and self.lease_token == token:
+                self.logger_http_client.error(f"Lease lost: {response['message']}")
+                self.lease_token = None
+
+    def get_lease_status(self):
+        """Requests the lease holder and the clients waiting for the next lease."""
+        if not self.connected:
+            self.logger_http_client.error("Request failed: Not connected to server")
+            return {"status": "error", "message": "Not connected to server"}
+
+        return self.send_message(json.dumps({"type": "lease"}),"lease")
+
     def get_status(self):
         """Checks and returns the current connection status."""
         self.logger_http_client.info("Sending status request")
@@ -233,13 +377,15 @@ class RobotControlAPI:
                 self.connected = False
                 break
 
-    def set_safe_bounds(self,bounds: list[int]):
+    def set_safe_bounds(self,bounds: list):
         self.logger_http_client.info(f"Setting bounds to {bounds}")
         if not self.connected:
             self.logger_http_client.error("Bounds command not sent: Not connected to server")
             return{"status": "error", "message": "Not connected to server"}
 
-        bounds = sorted(bounds)
+        # Scalars may come in either order, per channel bounds are sent as [lower, upper] and checked by the server
+        if not isinstance(bounds[0], list) and not isinstance(bounds[1], list):
+            bounds = sorted(bounds)
         command = {
             "lower": bounds[0],
             "upper": bounds[1]
@@ -249,32 +395,79 @@ class RobotControlAPI:
         self.send_message(command_str, "set_safe_bounds")
         return{"status": "success", "message": f"Set bounds command sent: {bounds}"}
         
-    def send_message(self, message:str, endpoint:str) -> dict[str,str]:
-        if self.connected:
-            try:
-                self.logger_http_client.info(f"Sending message: {message}")
-                # Send the HTTP POST request to the server with the message
-                # Change this line in your Python client:
-                post_endpoints = ["aspirate","dispense","set_parameters","set_safe_bounds","set_calibration_offset"]
-                if endpoint in post_endpoints:
-                    response = requests.post(f"{self.server_url}/{endpoint}", json=json.loads(message))
-                else:
-                    response = requests.get(f"{self.server_url}/{endpoint}")
-                status_code = response.status_code
-                response = response.json()
-                match status_code:
-                    case 200:   self.logger_http_client.info(response["message"])
-                    case 400:   self.logger_http_client.warning(response["message"])
-                    case 504:   self.logger_http_client.critical(response["message"])
-                    case _:     self.logger_http_client.error(response["message"])
-                return response
-            except requests.exceptions.RequestException as e:
-                if (not self.check_server_availability()):
-                    error = "Server has disconnected"
-                else:
-                    error = f"Error sending message: {e}"
-                self.logger_http_client.error("Server has disconnected")
-                return {"status":"error","message":error}
+    def send_message(self, message:str, endpoint:str, expected_duration: float = 0) -> dict[str,str]:
+        if self.connected or self.check_server_availability():
+            headers = {"X-Client-ID": self.client_id}
+            if self.lease_token is not None:
+                headers["X-Lease-Token"] = self.lease_token
+            if endpoint in self.mutating_endpoints:
+                # The same key is sent on every retry, the server replays the original result
+                headers["Idempotency-Key"] = uuid4().hex
+            timeout = self.request_timeout + expected_duration + self.queue_wait
+            attempt = 0
+            in_progress_deadline = None
+            while True:
+                # Cached endpoint, re-probed in the background once its TTL has passed
+                if not self.check_server_availability():
+                    self.logger_http_client.error("Server has disconnected")
+                    return {"status":"error","message":"Server has disconnected"}
+                try:
+                    self.logger_http_client.info(f"Sending message: {message}")
+                    # Send the HTTP POST request to the server with the message
+                    if endpoint in self.post_endpoints:
+                        response = requests.post(f"{self.server_url}/{endpoint}", json=json.loads(message), headers=headers, timeout=timeout)
+                    else:
+                        response = requests.get(f"{self.server_url}/{endpoint}", headers=headers, timeout=timeout)
+                    status_code = response.status_code
+                    self.resolver.mark_healthy(self.server_url)
+                    self.queue_wait = float(response.headers.get("X-Queue-Wait", 0))
+                    self.steps_per_ul = float(response.headers.get("X-Steps-Per-Ul", self.steps_per_ul))
+                    self.acceleration = float(response.headers.get("X-Acceleration", self.acceleration))
+                    if status_code == 409 and response.json().get("in_progress"):
+                        # The original request is running on the robot, come back when the server expects it done
+                        if in_progress_deadline is None:
+                            in_progress_deadline = monotonic() + self.max_in_progress_wait
+                        if monotonic() < in_progress_deadline:
+                            delay = float(response.headers.get("Retry-After", self.retry_backoff))
+                            self.logger_http_client.info(f"Command still running on the robot, checking again in {delay}s")
+                            sleep(delay)
+                            continue
+                    if status_code in (409, 429, 503) and attempt < self.max_retries:
+                        attempt += 1
+                        delay = float(response.headers.get("Retry-After", self.retry_backoff))
+                        self.logger_http_client.warning(f"Server busy ({status_code}), retry {attempt}/{self.max_retries} in {delay}s")
+                        sleep(delay)
+                        continue
+                    response = response.json()
+                    match status_code:
+                        case 200:   self.logger_http_client.info(response["message"])
+                        case 400:   self.logger_http_client.warning(response["message"])
+                        case 202 | 423 | 428 | 429 | 503: self.logger_http_client.warning(response["message"])
+                        case 504:   self.logger_http_client.critical(response["message"])
+                        case _:     self.logger_http_client.error(response["message"])
+                    return response
+                except requests.exceptions.RequestException as e:
+                    if isinstance(e, requests.exceptions.ConnectionError):
+                        # The endpoint is gone, re-resolve before spending a retry and its backoff on it
+                        failed_url = self.server_url
+                        self.resolver.invalidate()
+                        if attempt < self.max_retries and self.check_server_availability() and self.server_url != failed_url:
+                            attempt += 1
+                            self.logger_http_client.warning(f"Request to {failed_url} failed, retry {attempt}/{self.max_retries} on {self.server_url}")
+                            continue
+                    if attempt < self.max_retries:
+                        delay = self.retry_backoff * 2**attempt
+                        attempt += 1
+                        self.logger_http_client.warning(f"Request failed ({e.__class__.__name__}), retry {attempt}/{self.max_retries} in {delay}s")
+                        sleep(delay)
+                        continue
+                    self.resolver.invalidate()
+                    if (not self.check_server_availability()):
+                        error = "Server has disconnected"
+                    else:
+                        error = f"Error sending message: {e}"
+                    self.logger_http_client.error("Server has disconnected")
+                    return {"status":"error","message":error}
         else:
             error = "Server has disconnected"
-            return {"status":"error","message":error}
\ No newline at end of file
+            return {"status":"error","message":error}
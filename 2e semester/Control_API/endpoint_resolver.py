@@ -0,0 +1,68 @@
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+class EndpointResolver:
+    def __init__(self, candidates: list[str], probe_timeout: float = 3, ttl: float = 30) -> None:
+        self.candidates = list(dict.fromkeys(candidates)) # Keeps the order, drops duplicates
+        self.probe_timeout = probe_timeout #s per probe, all candidates are probed at the same time
+        self.ttl = ttl #s a healthy endpoint is trusted before it gets re-probed
+
+        self.healthy_url: str | None = None
+        self.checked_at = 0.0
+        self.refreshing = False
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(len(self.candidates), 1), thread_name_prefix="EndpointProbe")
+
+    def probe(self, url: str) -> bool:
+        try:
+            return requests.get(f"{url}/ping", timeout=self.probe_timeout).status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    def probe_all(self) -> str | None:
+        # All candidates are probed at once, the first healthy one in the configured order wins.
+        # A dead preferred candidate costs one probe timeout, not one per candidate
+        futures = [self.executor.submit(self.probe, url) for url in self.candidates]
+        healthy_url = None
+        for url, future in zip(self.candidates, futures):
+            if future.result():
+                healthy_url = url
+                break
+        with self.lock:
+            self.healthy_url = healthy_url
+            self.checked_at = monotonic()
+            self.refreshing = False
+        return healthy_url
+
+    def resolve(self) -> str | None:
+        with self.lock:
+            healthy_url = self.healthy_url
+            age = monotonic() - self.checked_at
+        if healthy_url is None:
+            return self.probe_all()
+        if age > self.ttl:
+            # Keep using the known endpoint while it gets re-probed
+            self.refresh_in_background()
+        return healthy_url
+
+    def refresh_in_background(self) -> None:
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        # Own thread, probe_all itself waits on the probe pool
+        threading.Thread(target=self.probe_all, name="EndpointRefresh", daemon=True).start()
+
+    def mark_healthy(self, url: str) -> None:
+        # A successful request to the preferred candidate is as good as a probe. On a fallback the TTL keeps
+        # running, so the re-probe can switch back once the preferred candidate answers again
+        with self.lock:
+            self.healthy_url = url
+            if url == self.candidates[0]:
+                self.checked_at = monotonic()
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.healthy_url = None
@@ -4,6 +4,7 @@ from time import sleep
 import logging
 import colorlog
 from .robot_object_import import RobotObject
+from PythonServer_Package.logging_setup import remove_handlers
 
 class RobotControlAPI:
     def __init__(self,serial_port:str,baud_rate:int,log_files_path:str = "C:/Users/Sybe/Documents/!UAntwerpen/6e Semester/6 - Bachelorproef/Code/Github/6-BachelorProef_FTI-EM_CoSysLab/2e semester/PythonServer_Package/logs"):
@@ -49,6 +50,7 @@ class RobotControlAPI:
         file_handler_common_local.setFormatter(file_formatter_local)
 
         self.logger_local = logging.getLogger("Local")
+        remove_handlers(self.logger_local)
         self.logger_local.setLevel(logging.INFO)
         self.logger_local.addHandler(console_handler_local)
         self.logger_local.addHandler(file_handler_local)
@@ -130,10 +132,12 @@ class RobotControlAPI:
         except Exception as e:
             return self.exception_handler(str(e),"Error setting calibration offset")
 
-    def set_safe_bounds(self,bounds: list[int]):
+    def set_safe_bounds(self,bounds: list):
         self.logger_local.info(f"Setting safe bounds to {bounds}")
         try:
-            bounds = sorted(bounds)
+            # Scalars may come in either order, per channel bounds are [lower, upper] and checked by the robot
+            if not isinstance(bounds[0], list) and not isinstance(bounds[1], list):
+                bounds = sorted(bounds)
             response = self.robot.set_safe_bounds(bounds)
             self.logger_local.info(response["message"])
             return{"status": "success", "message": response["message"]}
@@ -148,6 +152,49 @@ class RobotControlAPI:
         except Exception as e:
             return self.exception_handler(str(e),"Error setting Volume to travel ratio")
         
+    def upload_program(self, steps: list):
+        self.logger_local.info(f"Uploading program of {len(steps)} steps")
+        try:
+            response = self.robot.upload_program(steps)
+            self.logger_local.info(response["message"])
+            return{"status": "success", "message": response["message"]}
+        except Exception as e:
+            return self.exception_handler(str(e),"Error uploading program")
+
+    def run_program(self):
+        self.logger_local.info("Running uploaded program")
+        try:
+            response = self.robot.run_program()
+            self.logger_local.info(response["message"])
+            return{"status": "success", "message": response["message"]}
+        except Exception as e:
+            return self.exception_handler(str(e),"Error running program")
+
+    def load_calibration(self, calibration_path: str, version: int | None = None):
+        self.logger_local.info(f"Loading calibration profile {version if version is not None else 'latest'} from {calibration_path}")
+        try:
+            response = self.robot.load_calibration_profile(calibration_path, version)
+            self.logger_local.info(response["message"])
+            return{"status": "success", "message": response["message"]}
+        except Exception as e:
+            return self.exception_handler(str(e),"Error loading calibration profile")
+
+    def set_telemetry_interval(self, interval_ms: int):
+        self.logger_local.info(f"Setting telemetry interval to {interval_ms}ms")
+        try:
+            response = self.robot.set_telemetry_interval(interval_ms=interval_ms)
+            self.logger_local.info(response["message"])
+            return{"status": "success", "message": response["message"]}
+        except Exception as e:
+            return self.exception_handler(str(e),"Error setting telemetry interval")
+
+    def get_telemetry(self):
+        try:
+            telemetry = self.robot.get_telemetry()
+            return{"status": "success", "message": f"{len(telemetry["time_ms"])} telemetry samples", "telemetry": telemetry}
+        except Exception as e:
+            return self.exception_handler(str(e),"Error requesting telemetry")
+
     def exception_handler(self, error_msg: str, error_template:str)->dict[str,str]:
         if error_msg == "Position out of safe bounds":
                 self.logger_local.warning(f"Error sending dispense command: {error_msg}")
@@ -1,3 +1,4 @@
 # Filename: __init__.py
 from .robot_server import RobotServer
-from .robot_object import RobotObject
\ No newline at end of file
+from .robot_object import RobotObject
+from .simulated_serial import SimulatedSerial
\ No newline at end of file
@@ -0,0 +1,200 @@
+import atexit
+import os
+import threading
+from datetime import datetime
+from time import monotonic, time
+import numpy as np
+from .protocol_program import OP_ASPIRATE, OP_DISPENSE, OP_EJECT, OP_MOVE, OP_ZERO
+
+# Run history: one raw little endian file per column, records appended in batches to numbered chunk directories
+# index.bin holds (chunk, first timestamp, last timestamp, count) per chunk, so a time range only touches its chunks
+COLUMNS = {
+    "timestamp": np.dtype("<f8"),   # s since the epoch, when the command was sent
+    "opcode": np.dtype("u1"),
+    "volume": np.dtype("<f4"),      # ul, first channel
+    "rate": np.dtype("<f4"),        # ul/s, first channel
+    "steps": np.dtype("<i4"),       # signed, first channel
+    "rtt": np.dtype("<f4"),         # s from write to reply, includes the motion
+    "result": np.dtype("u1"),       # 1 = success, 0 = failed
+    "error_code": np.dtype("<i2"),
+}
+RECORD = np.dtype([(name, dtype) for name, dtype in COLUMNS.items()])
+INDEX = np.dtype([("chunk", "<u4"), ("t_start", "<f8"), ("t_end", "<f8"), ("count", "<u4")])
+
+# Device opcodes are shared with the program bytecode, host-only commands follow
+OP_PING = 0x10
+OP_SET_PARAMETERS = 0x11
+OP_SET_OFFSET = 0x12
+OP_TELEMETRY = 0x13
+OP_UPLOAD = 0x14
+OP_RUN = 0x15
+OP_OTHER = 0xFF
+COMMAND_OPCODES = {"A": OP_ASPIRATE, "D": OP_DISPENSE, "E": OP_EJECT, "Z": OP_ZERO, "M": OP_MOVE, "S": OP_SET_PARAMETERS,
+                   "O": OP_SET_OFFSET, "T": OP_TELEMETRY, "U": OP_UPLOAD, "X": OP_RUN}
+
+# The wall clock is read once and advanced with the monotonic clock, a system clock change cannot reorder the history
+CLOCK_OFFSET = time() - monotonic()
+
+def history_time() -> float:
+    # s since the epoch, like time()
+    return CLOCK_OFFSET + monotonic()
+
+ERROR_NONE = 0
+ERROR_ROBOT = 1     # The device answered with an error
+ERROR_TIMEOUT = 2
+ERROR_INVALID = 3   # Reply was not valid JSON
+ERROR_SERIAL = 4
+ERROR_OTHER = 5
+
+def command_opcode(command: str) -> int:
+    if command == "Ping":
+        return OP_PING
+    return COMMAND_OPCODES.get(command[:1], OP_OTHER)
+
+def error_code(error: Exception | None) -> int:
+    # Maps the exceptions of RobotObject.send_command to a code
+    if error is None:
+        return ERROR_NONE
+    message = str(error)
+    if isinstance(error, TimeoutError):
+        return ERROR_TIMEOUT
+    if message.startswith("Robot could not execute command"):
+        return ERROR_ROBOT
+    if "JSON" in message or message == "Invalid serial input":
+        return ERROR_INVALID
+    if message in ("Error opening serial port", "Serial not available"):
+        return ERROR_SERIAL
+    return ERROR_OTHER
+
+def to_timestamp(value: float | datetime | None, default: float) -> float:
+    if value is None:
+        return default
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return float(value)
+
+class CommandHistory:
+    def __init__(self, directory: str, batch_size: int = 256, chunk_size: int = 65536, flush_interval: float = 5) -> None:
+        self.directory = directory
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size # records per chunk directory
+        self.flush_interval = flush_interval #s, a quiet robot still gets its records on disk
+        os.makedirs(directory, exist_ok=True)
+
+        self.index = self.load_index()
+        self.repair()
+        self.batch = np.zeros(batch_size, dtype=RECORD)
+        self.pending = 0
+        self.last_flush = history_time()
+        self.lock = threading.Lock()
+
+        # Records of an idle robot are written by the flush thread, the rest when the process exits
+        self.stopped = threading.Event()
+        self.flush_thread = threading.Thread(target=self.flush_periodically, name="CommandHistoryFlush", daemon=True)
+        self.flush_thread.start()
+        atexit.register(self.close)
+
+    def index_path(self) -> str:
+        return os.path.join(self.directory, "index.bin")
+
+    def chunk_path(self, chunk: int) -> str:
+        return os.path.join(self.directory, f"chunk_{chunk:06d}")
+
+    def load_index(self) -> np.ndarray:
+        if not os.path.exists(self.index_path()):
+            return np.zeros(0, dtype=INDEX)
+        return np.fromfile(self.index_path(), dtype=INDEX)
+
+    def repair(self) -> None:
+        # Column bytes written after the last index update are dropped, they would misalign the next batch
+        last = int(self.index[-1]["chunk"]) if self.index.size else -1
+        for chunk, count in ((last, int(self.index[-1]["count"]) if self.index.size else 0), (last + 1, 0)):
+            for name, dtype in COLUMNS.items():
+                path = os.path.join(self.chunk_path(chunk), f"{name}.bin")
+                if chunk >= 0 and os.path.exists(path) and os.path.getsize(path) > count * dtype.itemsize:
+                    os.truncate(path, count * dtype.itemsize)
+
+    def append(self, timestamp: float, opcode: int, volume: float = 0.0, rate: float = 0.0, steps: int = 0,
+               rtt: float = 0.0, result: bool = True, error_code: int = ERROR_NONE) -> None:
+        with self.lock:
+            self.batch[self.pending] = (timestamp, opcode, volume, rate, steps, rtt, result, error_code)
+            self.pending += 1
+            if self.pending >= self.batch_size or timestamp - self.last_flush >= self.flush_interval:
+                self.write_batch()
+
+    def flush_periodically(self) -> None:
+        while not self.stopped.wait(self.flush_interval):
+            with self.lock:
+                if self.pending and history_time() - self.last_flush >= self.flush_interval:
+                    self.write_batch()
+
+    def flush(self) -> None:
+        with self.lock:
+            self.write_batch()
+
+    def write_batch(self) -> None:
+        # Caller holds the lock. Fills the last chunk up to chunk_size, then starts the next one
+        if self.pending == 0:
+            return
+        # Rows of one batch may be appended out of order by concurrent callers, query() needs them sorted
+        self.batch[:self.pending] = self.batch[np.argsort(self.batch["timestamp"][:self.pending], kind="stable")]
+        written = 0
+        while written < self.pending:
+            if self.index.size == 0 or self.index[-1]["count"] >= self.chunk_size:
+                chunk = int(self.index[-1]["chunk"]) + 1 if self.index.size else 0
+                os.makedirs(self.chunk_path(chunk), exist_ok=True)
+                self.index = np.append(self.index, np.array([(chunk, self.batch[written]["timestamp"], 0, 0)], dtype=INDEX))
+            entry = self.index[-1:]
+            records = self.batch[written:written + min(self.pending - written, self.chunk_size - int(entry["count"][0]))]
+            for name in COLUMNS:
+                with open(os.path.join(self.chunk_path(int(entry["chunk"][0])), f"{name}.bin"), "ab") as column_file:
+                    column_file.write(np.ascontiguousarray(records[name]).tobytes())
+            entry["count"] += records.size
+            entry["t_end"] = max(float(entry["t_end"][0]), float(records["timestamp"].max()))
+            written += records.size
+        self.pending = 0
+        self.last_flush = history_time()
+        # The index is rewritten last, a crash before this only loses the records it does not count yet
+        temporary_path = self.index_path() + ".tmp"
+        self.index.tofile(temporary_path)
+        os.replace(temporary_path, self.index_path())
+
+    def query(self, start: float | datetime | None = None, end: float | datetime | None = None,
+              columns: list[str] | None = None) -> dict[str, np.ndarray]:
+        # Records with start <= timestamp <= end as one array per column, only the overlapping chunks are mapped
+        start = to_timestamp(start, -np.inf)
+        end = to_timestamp(end, np.inf)
+        columns = list(COLUMNS) if columns is None else columns
+        self.flush()
+        with self.lock:
+            index = self.index.copy()
+
+        parts: dict[str, list[np.ndarray]] = {name: [] for name in columns}
+        for entry in index[(index["t_end"] >= start) & (index["t_start"] <= end) & (index["count"] > 0)]:
+            path = self.chunk_path(int(entry["chunk"]))
+            count = int(entry["count"])
+            timestamps = np.memmap(os.path.join(path, "timestamp.bin"), dtype=COLUMNS["timestamp"], mode="r", shape=(count,))
+            # Records are appended in time order, the range is two binary searches
+            first = np.searchsorted(timestamps, start, side="left")
+            last = np.searchsorted(timestamps, end, side="right")
+            if first >= last:
+                continue
+            for name in columns:
+                column = np.memmap(os.path.join(path, f"{name}.bin"), dtype=COLUMNS[name], mode="r", shape=(count,))
+                parts[name].append(np.array(column[first:last]))
+        return {name: np.concatenate(arrays) if arrays else np.zeros(0, dtype=COLUMNS[name]) for name, arrays in parts.items()}
+
+    def get_status(self) -> dict:
+        with self.lock:
+            return {
+                "chunks": int(self.index.size),
+                "records": int(self.index["count"].sum()) + self.pending,
+                "pending": self.pending,
+                "t_start": float(self.index[0]["t_start"]) if self.index.size else None,
+                "t_end": float(self.index[-1]["t_end"]) if self.index.size else None,
+            }
+
+    def close(self) -> None:
+        self.stopped.set()
+        self.flush()
+        atexit.unregister(self.close)
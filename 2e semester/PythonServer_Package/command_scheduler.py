@@ -0,0 +1,180 @@
+import threading
+from collections import OrderedDict, deque
+from math import ceil
+from time import monotonic
+from typing import Any, Callable
+
+class QueueFullError(Exception):
+    def __init__(self, message: str, status_code: int, retry_after: float) -> None:
+        super().__init__(message)
+        self.status_code = status_code # 429 = client over its share, 503 = robot queue full
+        self.retry_after = retry_after # s
+
+    def retry_after_header(self) -> str:
+        return str(max(1, ceil(self.retry_after)))
+
+class SchedulerCore:
+    # Admission, round robin selection and estimates without threads or a clock, every time is passed in as now.
+    # CommandScheduler runs it on monotonic() time, the fleet simulator on simulated time.
+    # Commands only need an estimated_duration in s
+    def __init__(self, max_queue_depth: int = 16, max_client_depth: int = 4) -> None:
+        self.max_queue_depth = max_queue_depth
+        self.max_client_depth = max_client_depth
+
+        # One FIFO per client, clients are served round robin so one script cannot starve the others
+        self.client_queues: OrderedDict[str, deque] = OrderedDict()
+        self.queue_depth = 0
+        self.queued_work = 0.0 #s of estimated work waiting in the queues
+        self.current = None
+        self.current_started = 0.0
+
+        # Observed service time minus estimate, smoothed, covers serial and firmware overhead
+        self.overhead = 0.0 #s
+        self.overhead_smoothing = 0.2
+
+        self.completed = 0
+        self.rejected_queue_full = 0
+        self.rejected_client_limit = 0
+
+    def admit(self, client_id: str, command, now: float) -> None:
+        # Queues the command in the client's FIFO, or raises when the robot or the client is over its limit
+        client_queue = self.client_queues.get(client_id)
+        if self.queue_depth >= self.max_queue_depth:
+            self.rejected_queue_full += 1
+            raise QueueFullError("Robot command queue is full", 503, self.queue_wait(now))
+        if client_queue is not None and len(client_queue) >= self.max_client_depth:
+            self.rejected_client_limit += 1
+            raise QueueFullError("Too many queued commands for this client", 429, self.queue_wait(now, client_id))
+
+        if client_queue is None:
+            client_queue = self.client_queues[client_id] = deque()
+        client_queue.append(command)
+        self.queue_depth += 1
+        self.queued_work += command.estimated_duration
+
+    def next_command(self, now: float):
+        # Takes the head of the first client and moves that client to the back, the command becomes current
+        client_id, client_queue = next(iter(self.client_queues.items()))
+        command = client_queue.popleft()
+        if client_queue:
+            self.client_queues.move_to_end(client_id)
+        else:
+            del self.client_queues[client_id]
+        self.queue_depth -= 1
+        self.queued_work -= command.estimated_duration
+        self.current = command
+        self.current_started = now
+        return command
+
+    def finish(self, now: float) -> None:
+        # The current command is done, its service time corrects the overhead of the estimates
+        elapsed = now - self.current_started
+        self.overhead += self.overhead_smoothing * (elapsed - self.current.estimated_duration - self.overhead)
+        self.current = None
+        self.completed += 1
+
+    def queue_wait(self, now: float, client_id: str | None = None) -> float:
+        # s until a slot frees up, for the Retry-After of rejected commands
+        overhead = max(self.overhead, 0.0)
+        wait = 0.0
+        if self.current is not None:
+            remaining = self.current.estimated_duration + overhead - (now - self.current_started)
+            wait += max(remaining, 0.0)
+        if client_id is None:
+            # Slots free up as the queue drains, spread the retries over the clients' share of the queued work
+            queued = self.queued_work + overhead * self.queue_depth
+            return wait + queued / max(len(self.client_queues), 1)
+        # Round robin frees a slot for this client after every client ahead of it ran one command
+        for other_id, other_queue in self.client_queues.items():
+            wait += other_queue[0].estimated_duration + overhead
+            if other_id == client_id:
+                break
+        return wait
+
+    def completion_time(self, now: float, client_id: str, estimated_duration: float) -> float:
+        # s until a command submitted now by this client is done: round robin runs as many commands of every
+        # other client as this client has queued, plus one, before it
+        overhead = max(self.overhead, 0.0)
+        wait = estimated_duration + overhead
+        if self.current is not None:
+            wait += max(self.current.estimated_duration + overhead - (now - self.current_started), 0.0)
+        own_queue = self.client_queues.get(client_id)
+        ahead = len(own_queue) + 1 if own_queue is not None else 1
+        for other_id, other_queue in self.client_queues.items():
+            commands = list(other_queue) if other_id == client_id else list(other_queue)[:ahead]
+            wait += sum(command.estimated_duration + overhead for command in commands)
+        return wait
+
+class QueuedCommand:
+    def __init__(self, client_id: str, action: Callable[[], Any], estimated_duration: float) -> None:
+        self.client_id = client_id
+        self.action = action
+        self.estimated_duration = estimated_duration
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Exception | None = None
+
+class CommandScheduler(SchedulerCore):
+    def __init__(self, max_queue_depth: int = 16, max_client_depth: int = 4, default_duration: float = 0.5) -> None:
+        super().__init__(max_queue_depth=max_queue_depth, max_client_depth=max_client_depth)
+        self.default_duration = default_duration #s, used when no estimate is given
+
+        self.condition = threading.Condition()
+        self.worker = threading.Thread(target=self.process_commands, name="RobotCommandWorker", daemon=True)
+        self.worker.start()
+
+    def submit(self, client_id: str, action: Callable[[], Any], estimated_duration: float | None = None) -> Any:
+        # Blocks the calling request thread until the worker has executed the action
+        if estimated_duration is None:
+            estimated_duration = self.default_duration
+        command = QueuedCommand(client_id, action, estimated_duration)
+
+        with self.condition:
+            self.admit(client_id, command, monotonic())
+            self.condition.notify()
+
+        command.done.wait()
+        if command.error is not None:
+            raise command.error
+        return command.result
+
+    def process_commands(self) -> None:
+        while True:
+            with self.condition:
+                while self.queue_depth == 0:
+                    self.condition.wait()
+                command = self.next_command(monotonic())
+
+            try:
+                command.result = command.action()
+            except Exception as e:
+                command.error = e
+
+            with self.condition:
+                self.finish(monotonic())
+            command.done.set()
+
+    def estimate_wait(self, client_id: str | None = None) -> float:
+        # Caller holds the condition
+        return self.queue_wait(monotonic(), client_id)
+
+    def estimate_completion(self, client_id: str, estimated_duration: float | None = None) -> float:
+        if estimated_duration is None:
+            estimated_duration = self.default_duration
+        with self.condition:
+            return self.completion_time(monotonic(), client_id, estimated_duration)
+
+    def get_status(self) -> dict[str, Any]:
+        with self.condition:
+            return {
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "max_client_depth": self.max_client_depth,
+                "client_depths": {client_id: len(queue) for client_id, queue in self.client_queues.items()},
+                "queued_work_s": round(self.queued_work, 3),
+                "estimated_wait_s": round(self.estimate_wait(), 3),
+                "busy": self.current is not None,
+                "completed": self.completed,
+                "rejected_queue_full": self.rejected_queue_full,
+                "rejected_client_limit": self.rejected_client_limit,
+            }
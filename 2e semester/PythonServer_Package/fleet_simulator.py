@@ -0,0 +1,278 @@
+import heapq
+from collections import deque
+import numpy as np
+from .robot_object import RobotObject
+from .command_scheduler import QueueFullError, SchedulerCore
+from .simulated_serial import SimulatedSerial
+
+# Discrete-event model of clients -> RobotServer (waitress threads, CommandScheduler) -> serial link -> pipette
+# Clients are closed loop like a protocol script: the next transfer starts a think time after the last one ended
+# Times in s of simulated time, nothing sleeps
+
+DEFAULT_WORKLOAD = {
+    "robots": 1,
+    "clients": 2,              # Spread over the robots round robin
+    "hours": 8,
+    "arrival_rate": 0.05,      # 1/s, inverse of the mean think time between a client's transfers
+    "volume": [10, 200],       # ul, one value or a uniform [min, max]
+    "rate": [50, 200],         # ul/s, one value or a uniform [min, max]
+    "channels": 1,
+    "network_latency": 0.002,  # s one way between client and server
+    "http_overhead": 0.004,    # s of request handling in a waitress thread
+    "baud_rate": 9600,
+    "firmware_overhead": 0.002, # s of parsing and setup per command on the device
+    "refill_volume": 5000,     # ul dispensed before the source has to be refilled, 0 disables
+    "refill_time": 30,         # s the robot is stopped per refill
+    "max_queue_depth": 16,     # CommandScheduler defaults
+    "max_client_depth": 4,
+    "max_parked": 4,           # RobotServer default, threads kept for lease long-polls and duplicate waits
+    "max_retries": 3,          # RobotControlAPI default
+    "seed": 0,
+}
+
+class SimCommand:
+    def __init__(self, transfer: "SimTransfer", action: str) -> None:
+        self.transfer = transfer
+        self.action = action # "aspirate" or "dispense"
+        self.estimated_duration = 0.0 #s, what the server estimates, like run_robot_command
+        self.service = 0.0  #s the robot is actually busy
+        self.motion = 0.0
+        self.serial = 0.0
+        self.attempts = 0
+        self.sent_at = 0.0
+
+class SimTransfer:
+    def __init__(self, client_id: str, volume: float, rate: float, arrived_at: float) -> None:
+        self.client_id = client_id
+        self.volume = volume
+        self.rate = rate
+        self.arrived_at = arrived_at
+
+class SimRobot(SchedulerCore):
+    # One RobotServer with its robot: a waitress thread pool in front of the CommandScheduler's queueing core on simulated time
+    def __init__(self, index: int, workload: dict) -> None:
+        super().__init__(max_queue_depth=workload["max_queue_depth"], max_client_depth=workload["max_client_depth"])
+        self.index = index
+        self.http_threads = self.max_queue_depth + workload["max_parked"] + 4 # Same as RobotServer.http_threads
+        self.threads_busy = 0
+        self.backlog: deque[SimCommand] = deque()
+
+        self.dispensed = 0.0 #ul since the last refill
+        self.refilling = False
+
+        # Statistics
+        self.last_change = 0.0
+        self.queue_area = 0.0   # queue depth integrated over time
+        self.threads_area = 0.0
+        self.max_queue = 0
+        self.max_backlog = 0
+        self.motion_time = 0.0
+        self.serial_time = 0.0
+        self.firmware_time = 0.0
+        self.refill_time = 0.0
+        self.refills = 0
+        self.command_latencies: list[float] = []
+        self.transfer_latencies: list[float] = []
+        self.http_waits: list[float] = []
+        self.failed_transfers = 0
+
+    def record(self, now: float) -> None:
+        # Called before every state change, keeps the time weighted averages
+        self.queue_area += self.queue_depth * (now - self.last_change)
+        self.threads_area += self.threads_busy * (now - self.last_change)
+        self.last_change = now
+
+class FleetSimulator:
+    def __init__(self, workload: dict) -> None:
+        self.workload = {**DEFAULT_WORKLOAD, **workload}
+        self.rng = np.random.default_rng(self.workload["seed"])
+        self.robots = [SimRobot(index, self.workload) for index in range(self.workload["robots"])]
+        # Host side motion parameters and estimates come from RobotObject, the device side from the firmware model
+        self.host = RobotObject(num_channels=self.workload["channels"])
+        self.device = SimulatedSerial(num_channels=self.workload["channels"], acceleration=self.host.stepper_acceleration)
+        self.clients = {f"client-{index}": self.robots[index % len(self.robots)] for index in range(self.workload["clients"])}
+        self.events: list[tuple[float, int, str, object]] = []
+        self.sequence = 0
+        self.now = 0.0
+        self.completed_transfers = 0
+
+    def schedule(self, delay: float, kind: str, payload: object) -> None:
+        self.sequence += 1
+        heapq.heappush(self.events, (self.now + delay, self.sequence, kind, payload))
+
+    def draw(self, value) -> float:
+        if np.ndim(value) == 0:
+            return float(value)
+        return round(float(self.rng.uniform(value[0], value[1])), 1)
+
+    def prepare(self, command: SimCommand) -> None:
+        # Service time: command and reply over the serial link, firmware overhead and the motion itself
+        transfer = command.transfer
+        volume = self.host.format_channel_values(transfer.volume)
+        rate = self.host.format_channel_values(transfer.rate)
+        message = f"{'A' if command.action == 'aspirate' else 'D'}{volume} R{rate}"
+        reply, motion, _ = self.device.execute_command(message)
+        command.serial = (len(message) + len(reply) + 2) * 10 / self.workload["baud_rate"] # 8N1, 10 bits per byte
+        command.motion = motion
+        command.service = command.serial + motion + self.workload["firmware_overhead"]
+
+    def send(self, command: SimCommand) -> None:
+        command.attempts += 1
+        command.sent_at = self.now
+        self.schedule(self.workload["network_latency"], "http_arrival", command)
+
+    def run(self) -> dict:
+        duration = self.workload["hours"] * 3600
+        for client_id in self.clients:
+            if self.workload["arrival_rate"] > 0:
+                self.think(client_id)
+        handlers = {
+            "transfer_arrival": self.handle_transfer_arrival,
+            "http_arrival": self.handle_http_arrival,
+            "retry": self.send,
+            "http_done": self.handle_http_done,
+            "robot_done": self.handle_robot_done,
+            "refill_done": self.handle_refill_done,
+        }
+        while self.events and self.events[0][0] <= duration:
+            self.now, _, kind, payload = heapq.heappop(self.events)
+            handlers[kind](payload)
+        self.now = duration
+        for robot in self.robots:
+            robot.record(duration)
+        return self.report()
+
+    def think(self, client_id: str) -> None:
+        self.schedule(self.rng.exponential(1 / self.workload["arrival_rate"]), "transfer_arrival", client_id)
+
+    def handle_transfer_arrival(self, client_id: str) -> None:
+        transfer = SimTransfer(client_id, self.draw(self.workload["volume"]), self.draw(self.workload["rate"]), self.now)
+        self.send(SimCommand(transfer, "aspirate"))
+
+    def handle_http_arrival(self, command: SimCommand) -> None:
+        robot = self.clients[command.transfer.client_id]
+        robot.record(self.now)
+        if robot.threads_busy < robot.http_threads:
+            robot.threads_busy += 1
+            robot.http_waits.append(0.0)
+            self.schedule(self.workload["http_overhead"], "http_done", command)
+        else:
+            # Waitress backlog, the request waits for a free thread
+            robot.backlog.append(command)
+            robot.max_backlog = max(robot.max_backlog, len(robot.backlog))
+
+    def release_thread(self, robot: SimRobot) -> None:
+        robot.record(self.now)
+        if robot.backlog:
+            command = robot.backlog.popleft()
+            robot.http_waits.append(self.now - command.sent_at - self.workload["network_latency"])
+            self.schedule(self.workload["http_overhead"], "http_done", command)
+        else:
+            robot.threads_busy -= 1
+
+    def handle_http_done(self, command: SimCommand) -> None:
+        # CommandScheduler.submit: the server estimates the command, then the scheduler admits or rejects it
+        robot = self.clients[command.transfer.client_id]
+        client_id = command.transfer.client_id
+        command.estimated_duration = self.host.estimate_action_duration(command.transfer.volume, command.transfer.rate)
+        robot.record(self.now)
+        try:
+            robot.admit(client_id, command, self.now)
+        except QueueFullError as error:
+            self.release_thread(robot)
+            if command.attempts <= self.workload["max_retries"]:
+                # The client sleeps for the Retry-After header before sending it again
+                self.schedule(self.workload["network_latency"] + float(error.retry_after_header()), "retry", command)
+            else:
+                robot.failed_transfers += 1
+                self.think(client_id)
+            return
+
+        self.prepare(command)
+        robot.max_queue = max(robot.max_queue, robot.queue_depth)
+        if robot.current is None and not robot.refilling:
+            self.start_next(robot)
+
+    def start_next(self, robot: SimRobot) -> None:
+        if robot.queue_depth == 0:
+            return
+        robot.record(self.now)
+        command = robot.next_command(self.now)
+        self.schedule(command.service, "robot_done", command)
+
+    def handle_robot_done(self, command: SimCommand) -> None:
+        robot = self.clients[command.transfer.client_id]
+        robot.finish(self.now)
+        robot.motion_time += command.motion
+        robot.serial_time += command.serial
+        robot.firmware_time += self.workload["firmware_overhead"]
+        self.release_thread(robot)
+        robot.command_latencies.append(self.now + self.workload["network_latency"] - command.sent_at)
+
+        if command.action == "aspirate":
+            self.send(SimCommand(command.transfer, "dispense"))
+        else:
+            robot.transfer_latencies.append(self.now + self.workload["network_latency"] - command.transfer.arrived_at)
+            self.completed_transfers += 1
+            self.think(command.transfer.client_id)
+            robot.dispensed += command.transfer.volume * self.workload["channels"]
+            if self.workload["refill_volume"] > 0 and robot.dispensed >= self.workload["refill_volume"]:
+                robot.dispensed = 0.0
+                robot.refilling = True
+                robot.refills += 1
+                robot.refill_time += self.workload["refill_time"]
+                self.schedule(self.workload["refill_time"], "refill_done", robot)
+                return
+        self.start_next(robot)
+
+    def handle_refill_done(self, robot: SimRobot) -> None:
+        robot.refilling = False
+        self.start_next(robot)
+
+    def report(self) -> dict:
+        duration = self.now
+        robots = []
+        for robot in self.robots:
+            busy = robot.motion_time + robot.serial_time + robot.firmware_time + robot.refill_time
+            transfers = np.asarray(robot.transfer_latencies)
+            commands = np.asarray(robot.command_latencies)
+            waits = np.asarray(robot.http_waits)
+            if waits.size and commands.size and waits.mean() > 0.1 * commands.mean():
+                bottleneck = "http"
+            elif busy / duration < 0.8:
+                bottleneck = "none" # Not saturated, latency is set by the arrivals
+            else:
+                shares = {"serial": robot.serial_time, "motion": robot.motion_time, "refill": robot.refill_time, "firmware": robot.firmware_time}
+                bottleneck = max(shares, key=shares.get)
+            robots.append({
+                "robot": robot.index,
+                "clients": sum(1 for assigned in self.clients.values() if assigned is robot),
+                "transfers": int(transfers.size),
+                "transfers_per_hour": transfers.size / duration * 3600,
+                "utilization": busy / duration,
+                "motion_utilization": robot.motion_time / duration,
+                "serial_utilization": robot.serial_time / duration,
+                "refill_utilization": robot.refill_time / duration,
+                "refills": robot.refills,
+                "mean_queue": robot.queue_area / duration,
+                "max_queue": robot.max_queue,
+                "mean_http_threads": robot.threads_area / duration,
+                "max_http_backlog": robot.max_backlog,
+                "command_latency": percentiles(commands),
+                "transfer_latency": percentiles(transfers),
+                "http_wait": percentiles(waits),
+                "rejected_queue_full": robot.rejected_queue_full,
+                "rejected_client_limit": robot.rejected_client_limit,
+                "failed_transfers": robot.failed_transfers,
+                "bottleneck": bottleneck,
+            })
+        return {"hours": duration / 3600, "completed_transfers": self.completed_transfers, "robots": robots}
+
+def percentiles(values: np.ndarray) -> dict[str, float]:
+    if values.size == 0:
+        return {"mean": float("nan"), "p50": float("nan"), "p95": float("nan"), "p99": float("nan"), "max": float("nan")}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"mean": float(values.mean()), "p50": float(p50), "p95": float(p95), "p99": float(p99), "max": float(values.max())}
+
+def simulate_fleet(workload: dict) -> dict:
+    return FleetSimulator(workload).run()
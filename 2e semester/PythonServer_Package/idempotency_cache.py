@@ -0,0 +1,77 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Any
+
+class IdempotencyEntry:
+    def __init__(self, fingerprint: str = "") -> None:
+        self.fingerprint = fingerprint # hash of the request body, a reused key with another body is refused
+        self.done = threading.Event()
+        self.result: Any = None
+        self.completed_at = 0.0
+        self.expected_done = 0.0 # monotonic time the server expects the command to finish, 0 = unknown
+
+class IdempotencyCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 600) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl #s a completed result is kept after the command finished
+
+        # Least recently used first, in-flight operations live here too so duplicates can wait on them
+        self.entries: OrderedDict[str, IdempotencyEntry] = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def begin(self, key: str, fingerprint: str = "") -> tuple[bool, IdempotencyEntry]:
+        # Returns (True, entry) when the caller owns the operation and has to execute it
+        with self.lock:
+            self.evict_expired()
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return False, entry
+            entry = self.entries[key] = IdempotencyEntry(fingerprint)
+            self.misses += 1
+            self.evict_oldest()
+            return True, entry
+
+    def complete(self, key: str, entry: IdempotencyEntry, result: Any) -> None:
+        with self.lock:
+            entry.result = result
+            entry.completed_at = monotonic()
+        entry.done.set()
+
+    def abandon(self, key: str, entry: IdempotencyEntry, result: Any = None) -> None:
+        # The command never ran, forget the key so a retry executes it
+        with self.lock:
+            if self.entries.get(key) is entry:
+                del self.entries[key]
+            entry.result = result
+        entry.done.set()
+
+    def evict_expired(self) -> None:
+        # Caller holds the lock
+        now = monotonic()
+        expired = [key for key, entry in self.entries.items() if entry.done.is_set() and now - entry.completed_at > self.ttl]
+        for key in expired:
+            del self.entries[key]
+
+    def evict_oldest(self) -> None:
+        # Caller holds the lock. In-flight operations are never evicted
+        for key in list(self.entries.keys()):
+            if len(self.entries) <= self.max_entries:
+                break
+            if self.entries[key].done.is_set():
+                del self.entries[key]
+
+    def get_status(self) -> dict[str, int]:
+        with self.lock:
+            in_flight = sum(1 for entry in self.entries.values() if not entry.done.is_set())
+            return {
+                "entries": len(self.entries),
+                "in_flight": in_flight,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,145 @@
+import threading
+from collections import OrderedDict
+from math import ceil
+from time import monotonic
+from uuid import uuid4
+
+class LeaseError(Exception):
+    def __init__(self, message: str, status_code: int, retry_after: float = 0.0) -> None:
+        super().__init__(message)
+        self.status_code = status_code # 423 = robot leased to another client, 428 = lease required, 410 = lease expired
+        self.retry_after = retry_after # s
+
+    def retry_after_header(self) -> str:
+        return str(max(1, ceil(self.retry_after)))
+
+class Lease:
+    def __init__(self, client_id: str, duration: float) -> None:
+        self.token = uuid4().hex
+        self.client_id = client_id
+        self.duration = duration #s the lease lives without a heartbeat
+        self.acquired_at = monotonic()
+        self.expires_at = self.acquired_at + duration
+
+    def remaining(self) -> float:
+        return max(self.expires_at - monotonic(), 0.0)
+
+    def to_dict(self) -> dict:
+        return {"client_id": self.client_id, "duration": self.duration, "remaining": round(self.remaining(), 3)}
+
+class LeaseManager:
+    def __init__(self, default_duration: float = 30, max_duration: float = 300, max_waiters: int = 16, require_lease: bool = False, waiter_ttl: float = 15) -> None:
+        self.default_duration = default_duration #s
+        self.max_duration = max_duration #s, longer requests are capped
+        self.max_waiters = max_waiters
+        self.require_lease = require_lease # False lets token-less commands through while nobody holds the robot
+
+        self.lease: Lease | None = None
+        # Clients waiting for the next lease, first come first served. A waiter that stops polling is dropped
+        self.waiters: OrderedDict[str, float] = OrderedDict() # client_id -> last seen
+        self.waiter_ttl = waiter_ttl #s, a little over the longest long-poll, so an abandoned poll soon gives up its place
+
+        # Smoothed time a lease is held, used for the expected wait of the queue
+        self.hold_time = default_duration #s
+        self.hold_time_smoothing = 0.2
+
+        self.granted = 0
+        self.expired = 0
+
+        self.condition = threading.Condition()
+
+    def reclaim_expired(self) -> None:
+        # Caller holds the condition. Leases without a heartbeat and silent waiters are removed
+        now = monotonic()
+        if self.lease is not None and now >= self.lease.expires_at:
+            self.expired += 1
+            self.end_lease()
+        for client_id in [client_id for client_id, last_seen in self.waiters.items() if now - last_seen > self.waiter_ttl]:
+            del self.waiters[client_id]
+
+    def end_lease(self) -> None:
+        # Caller holds the condition
+        held = monotonic() - self.lease.acquired_at
+        self.hold_time += self.hold_time_smoothing * (held - self.hold_time)
+        self.lease = None
+        self.condition.notify_all()
+
+    def expected_wait(self, position: int) -> float:
+        # Caller holds the condition. Position 0 is next in line
+        current = self.lease.remaining() if self.lease is not None else 0.0
+        return current + position * self.hold_time
+
+    def acquire(self, client_id: str, duration: float | None = None, wait: float = 0) -> Lease | tuple[int, float]:
+        # Returns the lease, or (position, expected wait) when the client is queued for the next one
+        duration = min(duration or self.default_duration, self.max_duration)
+        deadline = monotonic() + wait
+        with self.condition:
+            while True:
+                self.reclaim_expired()
+                if self.lease is not None and self.lease.client_id == client_id:
+                    # Acquiring twice hands back the held lease, renewed
+                    self.lease.duration = duration
+                    self.lease.expires_at = monotonic() + duration
+                    return self.lease
+                if client_id not in self.waiters and len(self.waiters) >= self.max_waiters:
+                    raise LeaseError("Lease queue is full", 503, self.expected_wait(len(self.waiters)))
+                self.waiters[client_id] = monotonic() # Polling keeps the place in line
+                position = list(self.waiters).index(client_id)
+                if self.lease is None and position == 0:
+                    del self.waiters[client_id]
+                    self.lease = Lease(client_id, duration)
+                    self.granted += 1
+                    self.condition.notify_all()
+                    return self.lease
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return position, self.expected_wait(position)
+                # Woken on release and grant, the timeout catches expired leases and silent waiters
+                self.condition.wait(timeout=min(remaining, 1.0))
+
+    def heartbeat(self, token: str, duration: float | None = None) -> Lease:
+        with self.condition:
+            self.reclaim_expired()
+            if self.lease is None or self.lease.token != token:
+                raise LeaseError("Lease expired or unknown", 410)
+            if duration is not None:
+                self.lease.duration = min(duration, self.max_duration)
+            self.lease.expires_at = monotonic() + self.lease.duration
+            return self.lease
+
+    def release(self, token: str) -> None:
+        with self.condition:
+            self.reclaim_expired()
+            if self.lease is None or self.lease.token != token:
+                raise LeaseError("Lease expired or unknown", 410)
+            self.end_lease()
+
+    def check(self, token: str | None) -> None:
+        # Raises when a mutating command with this token may not run now
+        with self.condition:
+            self.reclaim_expired()
+            if self.lease is not None:
+                if token == self.lease.token:
+                    return
+                if token is not None:
+                    raise LeaseError("Lease expired or unknown", 410)
+                raise LeaseError(f"Robot is leased by {self.lease.client_id}", 423, self.lease.remaining())
+            if token is not None:
+                raise LeaseError("Lease expired or unknown", 410)
+            if self.require_lease:
+                raise LeaseError("Acquire a lease before sending commands", 428)
+            # Waiters do not reserve an idle robot, a poll that was abandoned would lock it until the waiter expires.
+            # A waiter still long-polling gets the lease as soon as it is released
+
+    def get_status(self) -> dict:
+        with self.condition:
+            self.reclaim_expired()
+            return {
+                "lease": self.lease.to_dict() if self.lease is not None else None,
+                "waiting": [{"client_id": client_id, "position": position, "expected_wait": round(self.expected_wait(position), 3)}
+                            for position, client_id in enumerate(self.waiters)],
+                "hold_time": round(self.hold_time, 3),
+                "granted": self.granted,
+                "expired": self.expired,
+                "require_lease": self.require_lease,
+            }
@@ -0,0 +1,7 @@
+import logging
+
+def remove_handlers(logger: logging.Logger) -> None:
+    # Calling setup_logging again replaces the handlers instead of stacking them, each one holds a file descriptor
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
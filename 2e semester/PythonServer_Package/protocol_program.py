@@ -0,0 +1,67 @@
+import struct
+
+# Bytecode of the on-device interpreter in serial_comms.ino, little endian, one opcode byte per instruction
+OP_END = 0x00
+OP_ASPIRATE = 0x01  # volume f32 (ul), rate f32 (ul/s)
+OP_DISPENSE = 0x02  # volume f32 (ul), rate f32 (ul/s)
+OP_EJECT = 0x03
+OP_ZERO = 0x04
+OP_WAIT = 0x05      # duration u32 (ms)
+OP_MOVE = 0x06      # steps i32 (signed), speed f32 (steps/s), exact steps from the calibration table
+
+OPERANDS = {
+    OP_END: struct.Struct("<"),
+    OP_ASPIRATE: struct.Struct("<ff"),
+    OP_DISPENSE: struct.Struct("<ff"),
+    OP_EJECT: struct.Struct("<"),
+    OP_ZERO: struct.Struct("<"),
+    OP_WAIT: struct.Struct("<I"),
+    OP_MOVE: struct.Struct("<if"),
+}
+OPCODES = {"aspirate": OP_ASPIRATE, "dispense": OP_DISPENSE, "eject": OP_EJECT, "zero": OP_ZERO, "wait": OP_WAIT, "move": OP_MOVE}
+MAX_PROGRAM_SIZE = 1024 # bytes, matches MAX_PROGRAM_SIZE in config.h
+
+def compile_program(instructions: list[tuple]) -> bytes:
+    # instructions are (opcode, *operands) with the opcodes above, e.g. (OP_ASPIRATE, 100.0, 50.0)
+    program = bytearray()
+    for opcode, *operands in instructions:
+        program.append(opcode)
+        program += OPERANDS[opcode].pack(*operands)
+    program.append(OP_END)
+    if len(program) > MAX_PROGRAM_SIZE:
+        raise Exception(f"Program of {len(program)} bytes does not fit in the device buffer of {MAX_PROGRAM_SIZE} bytes")
+    return bytes(program)
+
+def decode_program(program: bytes) -> list[tuple]:
+    instructions = []
+    offset = 0
+    while offset < len(program):
+        opcode = program[offset]
+        offset += 1
+        if opcode not in OPERANDS:
+            raise Exception(f"Unknown opcode {opcode} at byte {offset - 1}")
+        if opcode == OP_END:
+            return instructions
+        operands = OPERANDS[opcode].unpack_from(program, offset)
+        offset += OPERANDS[opcode].size
+        instructions.append((opcode, *operands))
+    raise Exception("Program is missing its end instruction")
+
+def parse_steps(steps: list) -> list[tuple]:
+    # JSON friendly steps like ["aspirate", 100, 50], ["wait", 1.5] (s) or ["eject"] into instructions
+    instructions = []
+    for step in steps:
+        name, *values = step
+        if name not in OPCODES or name == "move":
+            raise Exception(f"Unknown program step: {name}")
+        opcode = OPCODES[name]
+        if opcode in (OP_ASPIRATE, OP_DISPENSE):
+            volume, rate = float(values[0]), float(values[1])
+            if volume < 0 or rate <= 0:
+                raise Exception("Volume and rate must be positive")
+            instructions.append((opcode, volume, rate))
+        elif opcode == OP_WAIT:
+            instructions.append((opcode, int(round(float(values[0]) * 1000))))
+        else:
+            instructions.append((opcode,))
+    return instructions
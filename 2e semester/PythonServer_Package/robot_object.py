@@ -1,25 +1,64 @@
 import serial # Module needed for serial communication
 import logging
 import colorlog
+import numpy as np
 from math import pi
 from json import loads as dictify, JSONDecodeError
 from time import time
 import os
+from .telemetry import TelemetryBuffer
+from .serial_session import SerialRecorder
+from .volume_calibration import CalibrationProfile, CalibrationStore, VolumeLookupTable
+from .protocol_program import OP_ASPIRATE, OP_DISPENSE, OP_MOVE, OP_WAIT, OP_ZERO, compile_program, parse_steps
+from .command_history import ERROR_NONE, ERROR_ROBOT, CommandHistory, command_opcode, error_code, history_time
+from .logging_setup import remove_handlers
+
+def trapezoid_duration(distance, speed, acceleration: float) -> np.ndarray:
+    # Move time in s of a trapezoidal (or triangular for short moves) stepper profile, element wise
+    distance = np.abs(np.asarray(distance, dtype=np.float64))
+    speed = np.asarray(speed, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cruising = distance >= speed**2 / acceleration
+        duration = np.where(cruising, distance / speed + speed / acceleration, 2 * np.sqrt(distance / acceleration))
+    return np.where((distance > 0) & (speed > 0), duration, 0.0)
 
 class RobotObject:
-    def __init__(self, serial_port: str = 'COM3', baud_rate: int = 9600, timeout: int = 60) -> None:        
+    def __init__(self, serial_port: str = 'COM3', baud_rate: int = 9600, timeout: int = 60, telemetry_capacity: int = 10000, telemetry_downsample: int = 1, device = None, num_channels: int = 1, history_path: str | None = None) -> None:        
         self.serial_port = serial_port
         self.baud_rate = baud_rate
+        self.device = device # Serial-like object used instead of opening serial_port, e.g. a SerialReplay
 
-        self.current_volume = 0 #ul
-        self.safe_bounds = [0, 1000] #ul
+        # Per-channel state, one row per pipette channel
+        self.num_channels = num_channels
+        self.current_volumes = np.zeros(num_channels) #ul
+        self.safe_bounds = np.tile(np.array([0.0, 1000.0]), (num_channels, 1)) #ul, [lower, upper] per channel
         self.stepper_pipet_microsteps = 8
         self.pipet_lead = 1 #mm/rev
         self.volume_to_travel_ratio = (4/2)**2*pi
+        self.stepper_acceleration = 1000 #steps/s^2, matches the firmware
         self.timeout = timeout #s
         
         self.serial_connected = False
 
+        self.telemetry = TelemetryBuffer(capacity=telemetry_capacity, downsample=telemetry_downsample)
+        self.telemetry_interval = 0 #ms, 0 = disabled on the device
+
+        # With a calibration profile loaded, volumes are converted to exact step counts on the host
+        self.calibration_profile: CalibrationProfile | None = None
+        self.calibration_table: VolumeLookupTable | None = None
+
+        # Program uploaded to the device, and the expected volumes after each step while it runs
+        self.program: list[tuple] | None = None
+        self.program_steps: list[int] = []
+        # Completion events (time, index, success) of the running program, recorded after its X row
+        self.program_events: list[tuple[float, int, bool]] = []
+        self.last_sent_at = 0.0
+        self.program_trajectory: np.ndarray | None = None
+        self.program_callback = None
+
+        # Every executed command is appended to a columnar history, next to the logs unless a path is given
+        self.history: CommandHistory | None = CommandHistory(history_path) if history_path is not None else None
+
     def setup_logging(self, log_files_path: str)-> None:
         log_file_path_object = os.path.abspath(f"{log_files_path}/object.log")  # Relative path
         log_file_path_common = os.path.abspath(f"{log_files_path}/common_log.log")  # Relative path
@@ -56,12 +95,15 @@ class RobotObject:
 
         # Set up the logger for RobotObject
         self.logger_robot = logging.getLogger("RobotObject")
+        remove_handlers(self.logger_robot)
         self.logger_robot.setLevel(logging.INFO)  # Adjust log level as needed
         self.logger_robot.addHandler(console_handler_robot)
         self.logger_robot.addHandler(file_handler_object)
         self.logger_robot.addHandler(file_handler_common_object)
         self.logger_robot.propagate = False
         self.logger_robot.info("Robot logging set up")
+        if self.history is None:
+            self.history = CommandHistory(os.path.join(log_files_path, "history"))
 
     def connect_serial(self, serial_port: str = "", baud_rate:int = 0) -> None:
         # Open serial port
@@ -72,7 +114,11 @@ class RobotObject:
             baud_rate = self.baud_rate
         
         try:
-            self.ser = serial.Serial(serial_port, baud_rate, timeout=1)
+            if self.device is not None:
+                self.ser = self.device
+            else:
+                self.ser = serial.Serial(serial_port, baud_rate, timeout=1)
+                self.baud_rate = baud_rate
         except Exception as e:
             self.logger_robot.critical(f"Error opening serial port: {e}")
             width = len(str(e)) + 10
@@ -92,6 +138,9 @@ class RobotObject:
         if len(response)>0:
             self.serial_connected = True
             self.logger_robot.info("Serial responding")
+            device_channels = int(response.get("channels", 1))
+            if device_channels != self.num_channels:
+                self.logger_robot.warning(f"Device reports {device_channels} channels, RobotObject is configured for {self.num_channels}")
         else:
             self.serial_connected = False
             self.ser.close()
@@ -103,7 +152,23 @@ class RobotObject:
         except:
             pass
 
-    def send_command(self, command: str, print_confirmation: bool = True) -> dict:
+    def start_recording(self, session_path: str) -> dict[str,str]:
+        if isinstance(self.ser, SerialRecorder):
+            raise Exception("Serial session is already being recorded")
+        os.makedirs(os.path.dirname(os.path.abspath(session_path)), exist_ok=True)
+        self.ser = SerialRecorder(self.ser, session_path)
+        self.logger_robot.info(f"Recording serial session to {session_path}")
+        return {"status": "success", "message": f"Recording serial session to {session_path}"}
+
+    def stop_recording(self) -> dict[str,str]:
+        if not isinstance(self.ser, SerialRecorder):
+            raise Exception("No serial session is being recorded")
+        session_path = self.ser.path
+        self.ser = self.ser.stop()
+        self.logger_robot.info(f"Serial session saved to {session_path}")
+        return {"status": "success", "message": f"Serial session saved to {session_path}"}
+
+    def send_command(self, command: str, print_confirmation: bool = True, history_values: tuple | None = None) -> dict:
         try:
             self.ser.flush()
         except Exception as e:
@@ -119,50 +184,124 @@ class RobotObject:
         if print_confirmation:
             self.logger_robot.info(f"Sent command over Serial: {command}")
         
+        sent_at = self.last_sent_at = history_time()
         try:
             self.ser.write(command.encode('utf-8'))
         except Exception as e:
             self.logger_robot.critical(f"Error writing to serial port: {e}")
             self.serial_connected = False
+            self.record_command(command, sent_at, Exception("Error opening serial port"), history_values)
             raise Exception("Error opening serial port")
 
-        return self.receive_response(print_confirmation=print_confirmation)
-
-    def pipette_action(self, action: str, volume: int, rate: int, print_confirmation: bool = True)-> dict[str,str]:
+        try:
+            response = self.receive_response(print_confirmation=print_confirmation)
+        except Exception as e:
+            self.record_command(command, sent_at, e, history_values)
+            raise
+        self.record_command(command, sent_at, history_values=history_values)
+        return response
+
+    def record_command(self, command: str, sent_at: float, error: Exception | None = None, history_values: tuple | None = None) -> None:
+        # history_values = (opcode, volume, rate, steps) as requested, otherwise they are parsed from the command as sent
+        if self.history is None:
+            return
+        if history_values is not None:
+            self.history.append(sent_at, *history_values, history_time() - sent_at, error is None, error_code(error))
+            return
+        volume, rate, steps = 0.0, 0.0, 0
+        try:
+            if command[:1] in ("A", "D", "M") and "R" in command:
+                value = float(command[1:command.find("R")].split(",")[0])
+                speed = float(command[command.find("R") + 1:].split(",")[0])
+                if command[:1] == "M":
+                    steps = int(value)
+                    volume, rate = abs(value) / self.steps_per_ul(), speed / self.steps_per_ul()
+                else:
+                    volume, rate = value, speed
+                    steps = int(round(value * self.steps_per_ul())) * (-1 if command[:1] == "A" else 1)
+        except ValueError:
+            pass
+        self.history.append(sent_at, command_opcode(command), volume, rate, steps, history_time() - sent_at, error is None, error_code(error))
+
+    @property
+    def current_volume(self) -> float | list[float]:
+        return self.channel_output(self.current_volumes)
+
+    @current_volume.setter
+    def current_volume(self, volume: float | list[float]) -> None:
+        self.current_volumes = self.channel_values(volume).copy()
+
+    def channel_values(self, values: float | list[float]) -> np.ndarray:
+        # A single value is broadcast to every channel, otherwise one value per channel is expected
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim == 0:
+            return np.full(self.num_channels, float(values))
+        if values.shape != (self.num_channels,):
+            raise Exception(f"Expected 1 or {self.num_channels} channel values, got {values.size}")
+        return values
+
+    def channel_output(self, values: np.ndarray) -> float | list[float]:
+        return float(values[0]) if self.num_channels == 1 else values.tolist()
+
+    def format_channel_values(self, values: float | list[float]) -> str:
+        # Protocol format: "300" broadcasts, "300,250,..." is per channel
+        if np.ndim(values) == 0:
+            return f"{values}"
+        return ",".join(np.format_float_positional(value, trim='-') for value in self.channel_values(values))
+
+    def pipette_action(self, action: str, volume: float | list[float], rate: float | list[float], print_confirmation: bool = True)-> dict[str,str]:
         if not self.serial_connected:
             self.serial_connected = self.send_command("Ping")["status"] == "success"
             if not self.serial_connected:
                 raise Exception("Error opening serial port")
-            
-        if not self.is_action_safe(volume if action == 'aspirate' else -volume):
-            self.logger_robot.warning(f"Action unsafe: Volume {self.current_volume + volume} is out of bounds!")
+
+        volumes = self.channel_values(volume)
+        rates = self.channel_values(rate)
+        signed_volumes = volumes if action == 'aspirate' else -volumes
+
+        if not self.is_action_safe(signed_volumes):
+            self.logger_robot.warning(f"Action unsafe: Volume {self.channel_output(self.current_volumes + signed_volumes)} is out of bounds!")
             raise Exception("Position out of safe bounds")
         
-        if volume < 0 or rate < 0:
+        if np.any(volumes < 0) or np.any(rates < 0):
             raise Exception("Volume and rate must be positive")
         
         if print_confirmation:
             self.logger_robot.info(f"{action.capitalize()[:-1]}ing {volume} ul at a rate of {rate} ul/s")
 
+        if self.calibration_table is not None:
+            # Exact step counts from the calibration table, the device only has to move
+            direction = -1 if action == 'aspirate' else 1
+            steps = direction * self.calibration_table.volume_to_steps(volumes)
+            speeds = np.round(rates * self.steps_per_ul(), 2)
+            if np.ndim(volume) == 0 and np.ndim(rate) == 0:
+                command = f"M{int(steps[0])} R{float(speeds[0])}"
+            else:
+                command = f"M{self.format_channel_values(steps)} R{self.format_channel_values(speeds)}"
+        else:
+            steps = np.rint((-1 if action == 'aspirate' else 1) * volumes * self.steps_per_ul()).astype(np.int64)
+            command = f"{action[0].upper()}{self.format_channel_values(volume)} R{self.format_channel_values(rate)}"
+        # The history keeps the requested volume and rate, also when calibrated step counts are sent
+        history_values = (OP_ASPIRATE if action == 'aspirate' else OP_DISPENSE, volumes[0], rates[0], int(steps[0]))
         temp_timeout = self.timeout
         self.timeout = 60*2
-
-        command = f"{action[0].upper()}{volume} R{rate}"
-        success = self.send_command(command, print_confirmation=print_confirmation)["status"] == "success"
-        self.timeout = temp_timeout
+        try:
+            success = self.send_command(command, print_confirmation=print_confirmation, history_values=history_values)["status"] == "success"
+        finally:
+            self.timeout = temp_timeout
         if not success:
             raise Exception("Arduino failed to actuate pipette")
         
-        self.current_volume += volume if action == 'aspirate' else -volume
+        self.current_volumes += signed_volumes
 
         if print_confirmation:
             self.logger_robot.info(f"{action.capitalize()}d {volume} ul at a rate of {rate} ul/s. Current volume: {self.current_volume}ul")
         return {"status":"success","message":f"{action.capitalize()}d {volume} ul at a rate of {rate} ul/s. Current volume: {self.current_volume}ul"}
 
-    def aspirate_pipette(self, volume: int, rate: int, print_confirmation: bool = True)-> dict[str,str]:
+    def aspirate_pipette(self, volume: float | list[float], rate: float | list[float], print_confirmation: bool = True)-> dict[str,str]:
         return self.pipette_action('aspirate', volume, rate, print_confirmation)
 
-    def dispense_pipette(self, volume: int, rate: int, print_confirmation: bool = True)-> dict[str,str]:
+    def dispense_pipette(self, volume: float | list[float], rate: float | list[float], print_confirmation: bool = True)-> dict[str,str]:
         return self.pipette_action('dispense', volume, rate, print_confirmation)
 
     def eject_tip(self, print_confirmation: bool = True)-> dict[str,str]:
@@ -182,6 +321,10 @@ class RobotObject:
         parameter_command = f"S{self.stepper_pipet_microsteps} L{self.pipet_lead} V{self.volume_to_travel_ratio}"
         self.send_command(parameter_command, print_confirmation=print_confirmation)
 
+        if self.calibration_profile is not None:
+            # Step counts depend on the mechanics, rebuild the table
+            self.set_calibration_profile(self.calibration_profile, self.calibration_table.max_volume, print_confirmation=False)
+
         confirmation_string = ""
         confirmation_string += f"Microsteps: {self.stepper_pipet_microsteps} " * (stepper_pipet_microsteps != 0)
         confirmation_string += f"Lead: {self.pipet_lead} " * (pipet_lead != 0)
@@ -198,18 +341,185 @@ class RobotObject:
         self.send_command(f"O{offset}", print_confirmation=print_confirmation)
         return {"status": "success", "message": f"Calibration set to {offset} ul"}
 
-    def get_current_volume(self) -> int:
+    def set_calibration_profile(self, profile: CalibrationProfile, max_volume: float | None = None, print_confirmation: bool = True) -> dict[str,str]:
+        if max_volume is None:
+            # Volumes above the calibrated range are rejected by the table instead of silently under-delivered
+            max_volume = min(float(self.safe_bounds[:, 1].max()), float(profile.delivered_volumes[-1]))
+        self.calibration_table = VolumeLookupTable(profile, self.steps_per_ul(), max_volume=max_volume)
+        self.calibration_profile = profile
+        if print_confirmation:
+            self.logger_robot.info(f"Calibration profile v{profile.version} loaded for 0 - {max_volume} ul")
+        return {"status": "success", "message": f"Calibration profile v{profile.version} loaded"}
+
+    def load_calibration_profile(self, calibration_path: str, version: int | None = None, print_confirmation: bool = True) -> dict[str,str]:
+        profile = CalibrationStore(calibration_path).load(version)
+        return self.set_calibration_profile(profile, print_confirmation=print_confirmation)
+
+    def clear_calibration_profile(self) -> dict[str,str]:
+        self.calibration_profile = None
+        self.calibration_table = None
+        return {"status": "success", "message": "Calibration profile cleared, the device converts volumes"}
+
+    def program_volumes(self, instructions: list[tuple]) -> np.ndarray:
+        # Expected volume of every channel after each instruction, starting from the current volume
+        trajectory = np.empty((len(instructions), self.num_channels))
+        volumes = self.current_volumes.copy()
+        for index, (opcode, *operands) in enumerate(instructions):
+            if opcode == OP_ASPIRATE:
+                volumes = volumes + operands[0]
+            elif opcode == OP_DISPENSE:
+                volumes = volumes - operands[0]
+            elif opcode == OP_ZERO:
+                volumes = np.zeros(self.num_channels)
+            trajectory[index] = volumes
+        return trajectory
+
+    def is_program_safe(self, trajectory: np.ndarray) -> bool:
+        return bool(np.all((self.safe_bounds[:, 0] <= trajectory) & (trajectory <= self.safe_bounds[:, 1])))
+
+    def estimate_program_duration(self, instructions: list[tuple]) -> float:
+        duration = 0.0
+        for opcode, *operands in instructions:
+            if opcode in (OP_ASPIRATE, OP_DISPENSE):
+                duration += self.estimate_action_duration(operands[0], operands[1])
+            elif opcode == OP_WAIT:
+                duration += operands[0] / 1000
+        return duration
+
+    def upload_program(self, steps: list, print_confirmation: bool = True) -> dict[str,str]:
+        instructions = parse_steps(steps)
+        if not self.is_program_safe(self.program_volumes(instructions)):
+            self.logger_robot.warning("Program unsafe: Volume goes out of bounds")
+            raise Exception("Position out of safe bounds")
+
+        device_instructions = instructions
+        if self.calibration_table is not None:
+            # Calibrated step counts are baked into the program, the device only moves
+            device_instructions = []
+            for opcode, *operands in instructions:
+                if opcode in (OP_ASPIRATE, OP_DISPENSE):
+                    steps_count = int(self.calibration_table.volume_to_steps(operands[0]))
+                    direction = -1 if opcode == OP_ASPIRATE else 1
+                    device_instructions.append((OP_MOVE, direction * steps_count, operands[1] * self.steps_per_ul()))
+                else:
+                    device_instructions.append((opcode, *operands))
+        program = compile_program(device_instructions)
+
+        if print_confirmation:
+            self.logger_robot.info(f"Uploading program of {len(instructions)} steps ({len(program)} bytes)")
+        self.send_command(f"U{program.hex()}", print_confirmation=print_confirmation)
+        self.program = instructions
+        # First channel steps per instruction, for the history rows of the completion events
+        self.program_steps = []
+        for opcode, *operands in device_instructions:
+            if opcode == OP_MOVE:
+                self.program_steps.append(int(operands[0]))
+            elif opcode in (OP_ASPIRATE, OP_DISPENSE):
+                self.program_steps.append(int(round(operands[0] * self.steps_per_ul())) * (-1 if opcode == OP_ASPIRATE else 1))
+            else:
+                self.program_steps.append(0)
+        return {"status": "success", "message": f"Uploaded program of {len(instructions)} steps ({len(program)} bytes)",
+                "expected_duration": self.estimate_program_duration(instructions)}
+
+    def run_program(self, on_event = None, print_confirmation: bool = True) -> dict[str,str]:
+        # on_event(index, success) is called for every completion event the device streams back
+        if self.program is None:
+            raise Exception("No program uploaded")
+        trajectory = self.program_volumes(self.program)
+        if not self.is_program_safe(trajectory):
+            self.logger_robot.warning("Program unsafe: Volume goes out of bounds")
+            raise Exception("Position out of safe bounds")
+
+        if print_confirmation:
+            self.logger_robot.info(f"Running program of {len(self.program)} steps")
+        temp_timeout = self.timeout
+        self.timeout = self.estimate_program_duration(self.program) + 60*2
+        self.program_trajectory = trajectory
+        self.program_callback = on_event
+        self.program_events = []
+        try:
+            self.send_command("X", print_confirmation=print_confirmation)
+        finally:
+            self.timeout = temp_timeout
+            self.record_program_steps(self.last_sent_at)
+            self.program_trajectory = None
+            self.program_callback = None
+
+        if print_confirmation:
+            self.logger_robot.info(f"Program of {len(self.program)} steps completed. Current volume: {self.current_volume}ul")
+        return {"status": "success", "message": f"Program of {len(self.program)} steps completed. Current volume: {self.current_volume}ul"}
+
+    def handle_program_event(self, line: str, print_confirmation: bool = True) -> bool:
+        # Completion events look like "P<index>,<1 = success, 0 = failed>"
+        if self.program_trajectory is None or not line.startswith("P"):
+            return False
+        try:
+            index, success = (int(value) for value in line[1:].split(","))
+        except ValueError:
+            return False
+        if success and 0 <= index < len(self.program_trajectory):
+            self.current_volumes = self.program_trajectory[index].copy()
+        self.program_events.append((history_time(), index, bool(success)))
+        if print_confirmation:
+            self.logger_robot.info(f"Program step {index} {'completed' if success else 'failed'}")
+        if self.program_callback is not None:
+            self.program_callback(index, bool(success))
+        return True
+
+    def record_program_steps(self, started: float) -> None:
+        # One history row per program step, timed from the previous completion event. They are appended after
+        # the X row that started the program, so the history stays in time order
+        for finished, index, success in self.program_events:
+            if self.history is not None and 0 <= index < len(self.program):
+                opcode, *operands = self.program[index]
+                volume, rate = (operands[0], operands[1]) if opcode in (OP_ASPIRATE, OP_DISPENSE) else (0.0, 0.0)
+                steps = self.program_steps[index] if index < len(self.program_steps) else 0
+                self.history.append(started, opcode, volume, rate, steps, finished - started, success, ERROR_NONE if success else ERROR_ROBOT)
+            started = finished
+        self.program_events = []
+
+    def set_telemetry_interval(self, interval_ms: int = 0, print_confirmation: bool = True) -> dict[str,str]:
+        if interval_ms < 0:
+            raise Exception("Telemetry interval must be positive")
+        min_interval = TelemetryBuffer.min_interval(self.baud_rate)
+        if 0 < interval_ms < min_interval:
+            raise Exception(f"Telemetry interval of {interval_ms} ms is too short for {self.baud_rate} baud, minimum is {min_interval} ms")
+        if print_confirmation:
+            self.logger_robot.info(f"Setting telemetry interval to: {interval_ms} ms")
+        self.send_command(f"T{interval_ms}", print_confirmation=print_confirmation)
+        self.telemetry_interval = interval_ms
+        state = f"every {interval_ms} ms" if interval_ms > 0 else "disabled"
+        return {"status": "success", "message": f"Telemetry {state}"}
+
+    def get_telemetry(self, last: int = 0, since: float | None = None) -> dict[str,list[float]]:
+        return self.telemetry.as_dict(last=last, since=since)
+
+    def clear_telemetry(self) -> None:
+        self.telemetry.clear()
+
+    def steps_per_ul(self) -> float:
+        return 200 * self.stepper_pipet_microsteps / (self.volume_to_travel_ratio * self.pipet_lead)
+
+    def estimate_action_duration(self, volume: float | list[float], rate: float | list[float]) -> float:
+        # Channels move simultaneously, the slowest one sets the duration
+        distance = np.asarray(volume, dtype=np.float64) * self.steps_per_ul()  # steps
+        speed = np.asarray(rate, dtype=np.float64) * self.steps_per_ul()       # steps/s
+        return float(np.max(trapezoid_duration(distance, speed, self.stepper_acceleration), initial=0.0))
+
+    def get_current_volume(self) -> float | list[float]:
         self.logger_robot.info(f"Received volume request: Current volume: {self.current_volume} ul")
         return self.current_volume
 
-    def is_action_safe(self, volume: int) -> bool:
-        self.logger_robot.info(f"Received safety request for v = {volume}ul with bounds = {self.safe_bounds} and current volume = {self.current_volume} ul")
-        return self.safe_bounds[0] <= self.current_volume + volume <= self.safe_bounds[1]
+    def is_action_safe(self, volume: float | list[float]) -> bool:
+        self.logger_robot.info(f"Received safety request for v = {volume}ul with bounds = {self.safe_bounds.tolist()} and current volume = {self.current_volume} ul")
+        new_volumes = self.current_volumes + self.channel_values(volume)
+        return bool(np.all((self.safe_bounds[:, 0] <= new_volumes) & (new_volumes <= self.safe_bounds[:, 1])))
 
     def zero_robot(self, print_confirmation: bool = True) -> dict[str,str]:
         response: dict[str,str] = self.send_command("Z", print_confirmation=print_confirmation)
         status = response["status"] == "success"
-        self.current_volume = 0 if status else self.current_volume
+        if status:
+            self.current_volumes[:] = 0
         if not status:
             raise Exception("Arduino failed to zero robot")
         else:
@@ -230,6 +540,7 @@ class RobotObject:
                 while not self.ser.in_waiting:
                     if time() - start_time > self.timeout:
                         raise TimeoutError(f"No response from Arduino after timeout of {self.timeout}s")
+                received = None
                 while self.ser.in_waiting:
                     # Receive data from the Arduino
                     try:
@@ -237,14 +548,22 @@ class RobotObject:
                     except:
                         raise Exception("Serial not available")
                     try:
-                        received:str = receive_string.decode('utf-8', 'ignore').rstrip()
+                        line:str = receive_string.decode('utf-8', 'ignore').rstrip()
                     except:
                         raise Exception("Invalid serial input")
+                    # Telemetry samples are streamed during motion, they go straight to the ring buffer
+                    if self.telemetry.parse_line(line):
+                        continue
+                    if self.handle_program_event(line, print_confirmation):
+                        continue
+                    received = line
                     # Print the data received from Arduino to the terminal
                     if print_confirmation:
                         self.logger_robot.info("Received over Serial: "+received)
                     if startup:
                         return dictify("status:success")
+                if received is None:
+                    continue
                 try:
                     sanitized_string = self.sanitize_json(received)
                     if sanitized_string == "":
@@ -266,15 +585,21 @@ class RobotObject:
                 except Exception as e:
                     if e.__class__ == JSONDecodeError:
                         self.logger_robot.error(f"JSON decode error: {e}")
-                    raise Exception(e)
+                    raise
         except Exception as e:
+            # Re-raised as is, wrapping it again on every level only grows the exception chain
             self.logger_robot.error(f"Exception in receive_response: {e}")
-            raise Exception(e)
+            raise
 
-    def set_safe_bounds(self, safe_bounds: list[int])-> dict[str,str]:
+    def set_safe_bounds(self, safe_bounds: list)-> dict[str,str]:
+        # [lower, upper], each either one value for all channels or one value per channel
         try:
             self.logger_robot.info(f"Received set safe bounds command: {safe_bounds}")
-            self.safe_bounds = safe_bounds
-            return {"status":"success","message":f"Safe bounds set succesfully: {self.safe_bounds}"}
+            lower = self.channel_values(safe_bounds[0])
+            upper = self.channel_values(safe_bounds[1])
+            if np.any(lower > upper):
+                raise Exception("Lower safe bound is above the upper safe bound")
+            self.safe_bounds = np.column_stack((lower, upper))
+            return {"status":"success","message":f"Safe bounds set succesfully: {self.safe_bounds[0].tolist() if self.num_channels == 1 else self.safe_bounds.tolist()}"}
         except Exception as e:
             raise e
\ No newline at end of file
@@ -1,12 +1,21 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
+from hashlib import sha256
+from math import ceil
+from time import monotonic
 from .robot_object import RobotObject
+from .command_scheduler import CommandScheduler, QueueFullError
+from .idempotency_cache import IdempotencyCache
+from .lease_manager import LeaseError, LeaseManager
+from .logging_setup import remove_handlers
 import logging
 import colorlog
 import os
+import threading
 
 class RobotServer:
-    def __init__(self, robot: RobotObject,log_files_path: str = "C:/Users/Sybe/Documents/!UAntwerpen/6e Semester/6 - Bachelorproef/Code/Github/6-BachelorProef_FTI-EM_CoSysLab/2e semester/PythonServer_Package/logs"):
+    def __init__(self, robot: RobotObject,log_files_path: str = "C:/Users/Sybe/Documents/!UAntwerpen/6e Semester/6 - Bachelorproef/Code/Github/6-BachelorProef_FTI-EM_CoSysLab/2e semester/PythonServer_Package/logs", max_queue_depth: int = 16, max_client_depth: int = 4, idempotency_cache_size: int = 1024, idempotency_ttl: float = 600, max_duplicate_wait: float = 5, max_parked: int = 4, calibration_path: str | None = None, lease_duration: float = 30, max_lease_duration: float = 300, require_lease: bool = False):
         self.app = Flask(__name__)
+        self.calibration_path = calibration_path # Directory with versioned calibration profiles
 
         # Set up logging
         self.setup_logging(log_files_path)
@@ -21,16 +30,38 @@ class RobotServer:
             self.logger_server.warning("Exiting server")
             exit(0)
 
+        # Every command that reaches the robot goes through one bounded, fair queue
+        self.scheduler = CommandScheduler(max_queue_depth=max_queue_depth, max_client_depth=max_client_depth)
+        # Results of mutating commands by Idempotency-Key, so client retries never actuate twice
+        self.idempotency_cache = IdempotencyCache(max_entries=idempotency_cache_size, ttl=idempotency_ttl)
+        self.max_duplicate_wait = max_duplicate_wait #s a duplicate holds a server thread before it is told to come back
+        # Lease long-polls and duplicate waits park a server thread, at most max_parked at a time, the rest get an answer right away
+        self.max_parked = max_parked
+        self.parked = threading.BoundedSemaphore(max_parked)
+        # One client at a time can hold the robot for a whole protocol, the others queue for the next lease
+        self.lease_manager = LeaseManager(default_duration=lease_duration, max_duration=max_lease_duration, max_waiters=max_queue_depth, require_lease=require_lease)
+
         # Define routes
-        self.app.add_url_rule('/aspirate', 'aspirate', self.handle_aspirate_command, methods=['POST'])
-        self.app.add_url_rule('/dispense', 'dispense', self.handle_dispense_command, methods=['POST'])
-        self.app.add_url_rule('/set_parameters', 'set_parameters', self.handle_set_parameters, methods=['POST'])
-        self.app.add_url_rule('/set_calibration_offset', 'set_calibration_offset', self.handle_set_calibration_offset, methods=['POST'])
-        self.app.add_url_rule('/set_safe_bounds', 'set_safe_bounds', self.handle_set_safe_bounds, methods=['POST'])
+        self.app.add_url_rule('/aspirate', 'aspirate', self.leased(self.idempotent(self.handle_aspirate_command)), methods=['POST'])
+        self.app.add_url_rule('/dispense', 'dispense', self.leased(self.idempotent(self.handle_dispense_command)), methods=['POST'])
+        self.app.add_url_rule('/set_parameters', 'set_parameters', self.leased(self.idempotent(self.handle_set_parameters)), methods=['POST'])
+        self.app.add_url_rule('/set_calibration_offset', 'set_calibration_offset', self.leased(self.idempotent(self.handle_set_calibration_offset)), methods=['POST'])
+        self.app.add_url_rule('/set_safe_bounds', 'set_safe_bounds', self.leased(self.idempotent(self.handle_set_safe_bounds)), methods=['POST'])
         self.app.add_url_rule('/ping', 'ping', self.handle_ping, methods=['GET'])
         self.app.add_url_rule('/request', 'request', self.handle_request, methods=['GET'])
-        self.app.add_url_rule('/zero_robot', 'zero_robot', self.zero_robot, methods=['GET'])
-        self.app.add_url_rule('/eject_tip', 'eject_tip', self.handle_eject, methods=['GET'])
+        self.app.add_url_rule('/zero_robot', 'zero_robot', self.leased(self.idempotent(self.zero_robot)), methods=['GET'])
+        self.app.add_url_rule('/eject_tip', 'eject_tip', self.leased(self.idempotent(self.handle_eject)), methods=['GET'])
+        self.app.add_url_rule('/load_calibration', 'load_calibration', self.leased(self.idempotent(self.handle_load_calibration)), methods=['POST'])
+        self.app.add_url_rule('/upload_program', 'upload_program', self.leased(self.idempotent(self.handle_upload_program)), methods=['POST'])
+        self.app.add_url_rule('/run_program', 'run_program', self.leased(self.idempotent(self.handle_run_program)), methods=['GET'])
+        self.app.add_url_rule('/set_telemetry', 'set_telemetry', self.leased(self.idempotent(self.handle_set_telemetry)), methods=['POST'])
+        self.app.add_url_rule('/telemetry', 'telemetry', self.handle_telemetry, methods=['GET'])
+        self.app.add_url_rule('/queue_status', 'queue_status', self.handle_queue_status, methods=['GET'])
+        self.app.add_url_rule('/lease/acquire', 'lease_acquire', self.handle_lease_acquire, methods=['POST'])
+        self.app.add_url_rule('/lease/heartbeat', 'lease_heartbeat', self.handle_lease_heartbeat, methods=['POST'])
+        self.app.add_url_rule('/lease/release', 'lease_release', self.handle_lease_release, methods=['POST'])
+        self.app.add_url_rule('/lease', 'lease_status', self.handle_lease_status, methods=['GET'])
+        self.app.after_request(self.add_queue_wait_header)
 
     def setup_logging(self,log_files_path:str):
         log_file_path_server = os.path.abspath(f"{log_files_path}/server_log.log") # Relative path
@@ -65,6 +96,7 @@ class RobotServer:
         file_handler_common_server.setFormatter(file_formatter_server)
 
         self.logger_server = logging.getLogger("Server")
+        remove_handlers(self.logger_server)
         self.logger_server.setLevel(logging.INFO)
         self.logger_server.addHandler(console_handler_server)
         self.logger_server.addHandler(file_handler_server)
@@ -79,10 +111,12 @@ class RobotServer:
             volume = command.get("volume")
             rate = command.get("rate")
             self.logger_server.info(f"Received aspirate command: volume={volume}, rate={rate}")
-            response = self.robot.aspirate_pipette(volume=volume, rate=rate)
+            response = self.run_robot_command(lambda: self.robot.aspirate_pipette(volume=volume, rate=rate), self.robot.estimate_action_duration(volume, rate))
             self.logger_server.info(f"{response["message"]}")
             return {"status": "Success", "message": response["message"]},200
         
+        except QueueFullError as e:
+            return self.queue_full_handler(e)
         except Exception as e:
             return self.exception_handler(str(e),"Error aspirating")
 
@@ -92,10 +126,12 @@ class RobotServer:
             volume = command.get("volume")
             rate = command.get("rate")
             self.logger_server.info(f"Received dispense command: volume={volume}, rate={rate}")
-            response = self.robot.dispense_pipette(volume=volume, rate=rate)
+            response = self.run_robot_command(lambda: self.robot.dispense_pipette(volume=volume, rate=rate), self.robot.estimate_action_duration(volume, rate))
             self.logger_server.info(f"{response["message"]}")
             return {"status": "Success", "message": f"{response["message"]}"},200
         
+        except QueueFullError as e:
+            return self.queue_full_handler(e)
         except Exception as e:
             return self.exception_handler(str(e), "Error dispensing")
 
@@ -107,7 +143,7 @@ class RobotServer:
         try:
             self.logger_server.info(f"Received volume request")
             current_volume = self.robot.get_current_volume()
-            return {"status": "Success", "message": f"Current volume: {current_volume} ul"},200
+            return {"status": "Success", "message": f"Current volume: {current_volume} ul", "volume": current_volume},200
         except Exception as e:
             return self.exception_handler(str(e), "Error handling volume request")
 
@@ -118,8 +154,10 @@ class RobotServer:
             lead = command.get("pipet_lead")
             vtr = command.get("volume_to_travel_ratio")
             self.logger_server.info(f"Received set parameters command: microsteps={microsteps}, lead={lead}, vtr={vtr}")
-            return self.robot.set_parameters(stepper_pipet_microsteps=microsteps, pipet_lead = lead, volume_to_travel_ratio = vtr),200
+            return self.run_robot_command(lambda: self.robot.set_parameters(stepper_pipet_microsteps=microsteps, pipet_lead = lead, volume_to_travel_ratio = vtr)),200
         
+        except QueueFullError as e:
+            return self.queue_full_handler(e)
         except Exception as e:
             return self.exception_handler(str(e), "Error handling set parameter command")
 
@@ -128,39 +166,251 @@ class RobotServer:
             command = request.get_json()
             offset:float = float(command.get("offset"))
             self.logger_server.info(f"Received calibration command: offset={offset}")
-            response = self.robot.set_calibration_offset(offset=offset)
+            response = self.run_robot_command(lambda: self.robot.set_calibration_offset(offset=offset))
             self.logger_server.info(f"{response["message"]}")
             return {"status": "Success", "message": response["message"]},200
+        except QueueFullError as e:
+            return self.queue_full_handler(e)
         except Exception as e:
             return self.exception_handler(str(e),"Error setting calibration")
 
+    def handle_load_calibration(self)->tuple[dict[str,str],int]:
+        try:
+            if self.calibration_path is None:
+                raise Exception("No calibration path configured on the server")
+            command = request.get_json()
+            version = command.get("version")
+            self.logger_server.info(f"Received load calibration command: version={version if version is not None else 'latest'}")
+            response = self.run_robot_command(lambda: self.robot.load_calibration_profile(self.calibration_path, version))
+            self.logger_server.info(f"{response["message"]}")
+            return {"status": "Success", "message": response["message"]},200
+        except QueueFullError as e:
+            return self.queue_full_handler(e)
+        except Exception as e:
+            return self.exception_handler(str(e),"Error loading calibration profile")
+
+    def handle_upload_program(self)->tuple[dict[str,str],int]:
+        try:
+            command = request.get_json()
+            steps = command.get("steps")
+            self.logger_server.info(f"Received upload program command: {len(steps)} steps")
+            response = self.run_robot_command(lambda: self.robot.upload_program(steps))
+            self.logger_server.info(f"{response["message"]}")
+            # Clients size the timeout of run_program with this
+            return {"status": "Success", "message": response["message"], "expected_duration": response["expected_duration"]},200
+        except QueueFullError as e:
+            return self.queue_full_handler(e)
+        except Exception as e:
+            return self.exception_handler(str(e),"Error uploading program")
+
+    def handle_run_program(self)->tuple[dict[str,str],int]:
+        try:
+            self.logger_server.info("Received run program command")
+            if self.robot.program is None:
+                raise Exception("No program uploaded")
+            estimated_duration = self.robot.estimate_program_duration(self.robot.program)
+            response = self.run_robot_command(self.robot.run_program, estimated_duration)
+            self.logger_server.info(f"{response["message"]}")
+            return {"status": "Success", "message": response["message"]},200
+        except QueueFullError as e:
+            return self.queue_full_handler(e)
+        except Exception as e:
+            return self.exception_handler(str(e),"Error running program")
+
     def handle_set_safe_bounds(self)->tuple[dict[str,str],int]:
         try:
             command = request.get_json()
             lower = command.get("lower")
             upper = command.get("upper")
             self.logger_server.info(f"Received set safe bounds command: [{upper},{lower}]")
-            return self.robot.set_safe_bounds([lower,upper]),200
+            return self.run_robot_command(lambda: self.robot.set_safe_bounds([lower,upper])),200
         
+        except QueueFullError as e:
+            return self.queue_full_handler(e)
         except Exception as e:
             return self.exception_handler(str(e),'Error setting safe bounds')
 
+    def handle_set_telemetry(self)->tuple[dict[str,str],int]:
+        try:
+            command = request.get_json()
+            interval_ms = int(command.get("interval_ms", 0))
+            self.logger_server.info(f"Received set telemetry command: interval={interval_ms} ms")
+            response = self.run_robot_command(lambda: self.robot.set_telemetry_interval(interval_ms=interval_ms))
+            self.logger_server.info(f"{response["message"]}")
+            return {"status": "Success", "message": response["message"]},200
+        except QueueFullError as e:
+            return self.queue_full_handler(e)
+        except Exception as e:
+            return self.exception_handler(str(e),"Error setting telemetry interval")
+
+    def handle_telemetry(self)->tuple[dict,int]:
+        try:
+            last = request.args.get("last", default=0, type=int)
+            since = request.args.get("since", default=None, type=float)
+            # Not logged on purpose, this endpoint gets polled during motion
+            samples = self.robot.get_telemetry(last=last, since=since)
+            return {"status": "Success", "message": f"{len(samples["time_ms"])} telemetry samples", "telemetry": samples},200
+        except Exception as e:
+            return self.exception_handler(str(e),"Error handling telemetry request")
+
     def handle_eject(self)->tuple[dict[str,str],int]:
         try:
             self.logger_server.info("Received eject tip command")
-            self.robot.eject_tip()
+            self.run_robot_command(self.robot.eject_tip)
             return {"status": "Success", "message": "Tip ejected"},200
+        except QueueFullError as e:
+            return self.queue_full_handler(e)
         except Exception as e:
             return self.exception_handler(str(e),"Error processing eject command")
 
     def zero_robot(self)->tuple[dict[str,str],int]:
         try:
             self.logger_server.info("Received zero robot command")
-            self.robot.zero_robot()
+            self.run_robot_command(self.robot.zero_robot)
             return {"status": "Success", "message": "Robot homed. Current volume: 0"},200
+        except QueueFullError as e:
+            return self.queue_full_handler(e)
         except Exception as e:
             return self.exception_handler(str(e),"Error processing zero_robot command")
 
+    def handle_queue_status(self)->tuple[dict,int]:
+        status = self.scheduler.get_status()
+        return {"status": "Success", "message": f"{status["queue_depth"]} commands queued", "queue": status, "idempotency": self.idempotency_cache.get_status()},200
+
+    def handle_lease_acquire(self)->tuple[dict,int]:
+        try:
+            command = request.get_json(silent=True) or {}
+            # Waiting is capped so a queued client cannot hold a server thread for long
+            wait = min(float(command.get("wait", 0)), 10)
+            parked = wait > 0 and self.parked.acquire(blocking=False)
+            try:
+                result = self.lease_manager.acquire(self.get_client_id(), command.get("duration"), wait if parked else 0)
+            finally:
+                if parked:
+                    self.parked.release()
+            if isinstance(result, tuple):
+                position, expected_wait = result
+                self.logger_server.info(f"Client {self.get_client_id()} queued for the lease at position {position}")
+                return ({"status": "Queued", "message": f"Waiting for the lease, position {position}, expected wait {expected_wait:.1f}s",
+                         "position": position, "expected_wait": expected_wait}, 202, {"Retry-After": str(max(1, min(int(expected_wait), 5)))})
+            self.logger_server.info(f"Lease granted to {result.client_id} for {result.duration}s")
+            return {"status": "Success", "message": f"Lease granted for {result.duration}s", "token": result.token, "lease": result.to_dict()},200
+        except LeaseError as e:
+            return self.lease_error_handler(e)
+        except Exception as e:
+            return self.exception_handler(str(e),"Error acquiring lease")
+
+    def handle_lease_heartbeat(self)->tuple[dict,int]:
+        try:
+            command = request.get_json(silent=True) or {}
+            lease = self.lease_manager.heartbeat(request.headers.get("X-Lease-Token", ""), command.get("duration"))
+            return {"status": "Success", "message": f"Lease renewed for {lease.duration}s", "lease": lease.to_dict()},200
+        except LeaseError as e:
+            return self.lease_error_handler(e)
+        except Exception as e:
+            return self.exception_handler(str(e),"Error renewing lease")
+
+    def handle_lease_release(self)->tuple[dict,int]:
+        try:
+            self.lease_manager.release(request.headers.get("X-Lease-Token", ""))
+            self.logger_server.info(f"Lease released by {self.get_client_id()}")
+            return {"status": "Success", "message": "Lease released"},200
+        except LeaseError as e:
+            return self.lease_error_handler(e)
+        except Exception as e:
+            return self.exception_handler(str(e),"Error releasing lease")
+
+    def handle_lease_status(self)->tuple[dict,int]:
+        status = self.lease_manager.get_status()
+        holder = status["lease"]["client_id"] if status["lease"] is not None else "nobody"
+        return {"status": "Success", "message": f"Robot leased by {holder}, {len(status["waiting"])} waiting", "lease": status},200
+
+    def lease_error_handler(self, error: LeaseError)->tuple[dict[str,str],int,dict[str,str]]:
+        self.logger_server.warning(f"Lease check failed for {self.get_client_id()}: {error}")
+        headers = {"Retry-After": error.retry_after_header()} if error.status_code in (423, 503) else {}
+        return {"status": "Error", "message": str(error)}, error.status_code, headers
+
+    def leased(self, handler):
+        # Wraps a mutating route: only the lease holder may actuate, checked before the idempotency cache
+        def leased_handler():
+            try:
+                self.lease_manager.check(request.headers.get("X-Lease-Token"))
+            except LeaseError as e:
+                return self.lease_error_handler(e)
+            return handler()
+        return leased_handler
+
+    def get_client_id(self) -> str:
+        return request.headers.get("X-Client-ID", request.remote_addr or "unknown")
+
+    def run_robot_command(self, action, estimated_duration: float | None = None):
+        entry = g.get("idempotency_entry")
+        if entry is not None:
+            # Duplicates of this request are told when to come back instead of waiting for it
+            entry.expected_done = monotonic() + self.scheduler.estimate_completion(self.get_client_id(), estimated_duration)
+        return self.scheduler.submit(self.get_client_id(), action, estimated_duration)
+
+    def add_queue_wait_header(self, response):
+        # Clients add the current queue wait to their timeouts, and estimate motion times with the robot's parameters
+        response.headers["X-Queue-Wait"] = f"{self.scheduler.estimate_completion(self.get_client_id(), 0):.3f}"
+        response.headers["X-Steps-Per-Ul"] = f"{self.robot.steps_per_ul():.6f}"
+        response.headers["X-Acceleration"] = f"{self.robot.stepper_acceleration:.1f}"
+        return response
+
+    def queue_full_handler(self, error: QueueFullError)->tuple[dict[str,str],int,dict[str,str]]:
+        retry_after = error.retry_after_header()
+        self.logger_server.warning(f"Rejected command from {self.get_client_id()}: {error}. Retry after {retry_after}s")
+        return {"status": "Error", "message": f"{error}, retry after {retry_after}s"}, error.status_code, {"Retry-After": retry_after}
+
+    def idempotent(self, handler):
+        # Wraps a mutating route: a repeated Idempotency-Key gets the original result without touching the robot
+        def idempotent_handler():
+            key = request.headers.get("Idempotency-Key")
+            if key is None:
+                return handler()
+            # Keys are scoped to the client, and a reused key must come with the same body
+            key = f"{self.get_client_id()}:{request.path}:{key}"
+            fingerprint = sha256(request.get_data()).hexdigest()
+
+            owner, entry = self.idempotency_cache.begin(key, fingerprint)
+            if not owner and entry.fingerprint != fingerprint:
+                self.logger_server.warning(f"Idempotency key {key} reused with a different request")
+                return {"status": "Error", "message": "Idempotency-Key was already used for a different request"}, 422
+            if not owner:
+                self.logger_server.info(f"Duplicate request for idempotency key {key}, waiting for the original result")
+                # Bounded, a duplicate must not hold one of the few server threads for a whole command
+                remaining = entry.expected_done - monotonic() if entry.expected_done else self.max_duplicate_wait
+                if self.parked.acquire(blocking=False):
+                    try:
+                        entry.done.wait(timeout=min(max(remaining, 0.1), self.max_duplicate_wait))
+                    finally:
+                        self.parked.release()
+                if not entry.done.is_set():
+                    remaining = max(entry.expected_done - monotonic(), 0) if entry.expected_done else self.max_duplicate_wait
+                    retry_after = str(max(1, ceil(remaining)))
+                    return ({"status": "Error", "message": f"Original request is still running, retry after {retry_after}s", "in_progress": True},
+                            409, {"Retry-After": retry_after})
+                if entry.result is None:
+                    return {"status": "Error", "message": "Original request failed, retry later"}, 409
+                body, status_code = entry.result[0], entry.result[1]
+                headers = dict(entry.result[2]) if len(entry.result) > 2 else {}
+                headers["Idempotent-Replayed"] = "true"
+                return body, status_code, headers
+
+            g.idempotency_entry = entry
+            try:
+                result = handler()
+            except Exception:
+                self.idempotency_cache.abandon(key, entry)
+                raise
+            if result[1] in (409, 429, 503):
+                # Rejected before reaching the robot, a retry has to execute it
+                self.idempotency_cache.abandon(key, entry, result)
+            else:
+                self.idempotency_cache.complete(key, entry, result)
+            return result
+        return idempotent_handler
+
     def handle_serial_error(self):
         return "Error opening serial port"
         error = "Error opening serial port"
@@ -184,7 +434,11 @@ class RobotServer:
             self.logger_server.error(f"{error_template}: {error_msg}")
         return {"status": "Error", "message": f"{error_template}: {error_msg}"}, 500
 
+    def http_threads(self) -> int:
+        # A full queue and every parked request still leave threads free to answer pings and rejections
+        return self.scheduler.max_queue_depth + self.max_parked + 4
+
     def run(self, host, port):
         from waitress import serve
         self.logger_server.info(f"Server running on http://{host}:{port}")
-        serve(self.app, host=host, port=port)
\ No newline at end of file
+        serve(self.app, host=host, port=port, threads=self.http_threads())
\ No newline at end of file
@@ -0,0 +1,197 @@
+import struct
+import threading
+from time import monotonic, perf_counter
+
+# Session file: MAGIC, then one record per serial event: kind (u8), seconds since start (f64), length (u32), payload
+MAGIC = b"RSS1"
+RECORD_HEADER = struct.Struct("<BdI")
+WRITE = 0
+READ = 1
+
+class SerialEvent:
+    def __init__(self, kind: int, timestamp: float, data: bytes) -> None:
+        self.kind = kind
+        self.timestamp = timestamp #s since the start of the session
+        self.data = data
+
+    def __repr__(self) -> str:
+        return f"SerialEvent({'write' if self.kind == WRITE else 'read'}, {self.timestamp:.6f}, {self.data!r})"
+
+def load_session(path: str) -> list[SerialEvent]:
+    with open(path, "rb") as session_file:
+        content = session_file.read()
+    if not content.startswith(MAGIC):
+        raise Exception(f"Not a serial session file: {path}")
+
+    events = []
+    offset = len(MAGIC)
+    while offset < len(content):
+        kind, timestamp, length = RECORD_HEADER.unpack_from(content, offset)
+        offset += RECORD_HEADER.size
+        events.append(SerialEvent(kind, timestamp, content[offset:offset + length]))
+        offset += length
+    return events
+
+def diff_sessions(path_a: str, path_b: str) -> list[str]:
+    # Compares the byte streams of two sessions, timing is ignored
+    events_a = load_session(path_a)
+    events_b = load_session(path_b)
+    differences = []
+    for index in range(max(len(events_a), len(events_b))):
+        a = events_a[index] if index < len(events_a) else None
+        b = events_b[index] if index < len(events_b) else None
+        if a is None or b is None or a.kind != b.kind or a.data != b.data:
+            differences.append(f"Event {index}: {a} != {b}")
+    return differences
+
+class SerialRecorder:
+    # Wraps a serial.Serial (or anything with the same interface) and logs every write and read
+    def __init__(self, ser, path: str) -> None:
+        self.ser = ser
+        self.path = path
+        self.session_file = open(path, "wb")
+        self.session_file.write(MAGIC)
+        self.start_time = monotonic()
+        self.lock = threading.Lock()
+
+    def record(self, kind: int, data: bytes) -> None:
+        if not data:
+            return
+        with self.lock:
+            self.session_file.write(RECORD_HEADER.pack(kind, monotonic() - self.start_time, len(data)))
+            self.session_file.write(data)
+
+    @property
+    def in_waiting(self) -> int:
+        return self.ser.in_waiting
+
+    @property
+    def is_open(self) -> bool:
+        return self.ser.is_open
+
+    def write(self, data: bytes) -> int:
+        self.record(WRITE, data)
+        return self.ser.write(data)
+
+    def readline(self) -> bytes:
+        data = self.ser.readline()
+        self.record(READ, data)
+        return data
+
+    def read_all(self) -> bytes:
+        data = self.ser.read_all()
+        self.record(READ, data)
+        return data
+
+    def flush(self) -> None:
+        self.ser.flush()
+        with self.lock:
+            self.session_file.flush()
+
+    def open(self) -> None:
+        self.ser.open()
+
+    def close(self) -> None:
+        self.ser.close()
+
+    def stop(self):
+        # Closes the session file and hands back the wrapped device
+        with self.lock:
+            self.session_file.close()
+        return self.ser
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+class SerialReplay:
+    # Serial-like device that answers with the reads of a recorded session
+    def __init__(self, path: str, realtime: bool = True) -> None:
+        self.path = path
+        self.realtime = realtime # False replays as fast as possible
+        self.events = load_session(path)
+        self.cursor = 0
+        self.pending: list[tuple[float, bytes]] = [] # (available at, data)
+        self.mismatches: list[tuple[int, bytes, bytes]] = [] # (event index, recorded write, actual write)
+        self.is_open = True
+        self.schedule_reads(monotonic(), 0.0)
+
+    def schedule_reads(self, now: float, reference: float) -> None:
+        # Queues the reads that followed the current write in the recording
+        while self.cursor < len(self.events) and self.events[self.cursor].kind == READ:
+            event = self.events[self.cursor]
+            delay = event.timestamp - reference if self.realtime else 0.0
+            self.pending.append((now + max(delay, 0.0), event.data))
+            self.cursor += 1
+
+    def ready(self) -> int:
+        now = monotonic()
+        count = 0
+        while count < len(self.pending) and self.pending[count][0] <= now:
+            count += 1
+        return count
+
+    @property
+    def in_waiting(self) -> int:
+        return sum(len(data) for _, data in self.pending[:self.ready()])
+
+    def write(self, data: bytes) -> int:
+        now = monotonic()
+        if self.cursor >= len(self.events):
+            self.mismatches.append((self.cursor, b"", data))
+            return len(data)
+        event = self.events[self.cursor]
+        if event.kind != WRITE or event.data != data:
+            self.mismatches.append((self.cursor, event.data if event.kind == WRITE else b"", data))
+        if event.kind == WRITE:
+            self.cursor += 1
+        self.schedule_reads(now, event.timestamp)
+        return len(data)
+
+    def readline(self) -> bytes:
+        if self.ready() == 0:
+            return b""
+        return self.pending.pop(0)[1]
+
+    def read_all(self) -> bytes:
+        ready = self.ready()
+        data = b"".join(data for _, data in self.pending[:ready])
+        del self.pending[:ready]
+        return data
+
+    def flush(self) -> None:
+        pass
+
+    def open(self) -> None:
+        self.is_open = True
+
+    def close(self) -> None:
+        self.is_open = False
+
+def recorded_commands(path: str) -> list[str]:
+    return [event.data.decode("utf-8", "ignore") for event in load_session(path) if event.kind == WRITE]
+
+def replay_session(robot, path: str, realtime: bool = False) -> dict:
+    # Drives robot.send_command with the recorded commands against a SerialReplay, for offline benchmarks
+    replay = SerialReplay(path, realtime=realtime)
+    robot.ser = replay
+    robot.serial_connected = True
+
+    latencies = []
+    errors = 0
+    start = perf_counter()
+    for command in recorded_commands(path):
+        command_start = perf_counter()
+        try:
+            robot.send_command(command, print_confirmation=False)
+        except Exception:
+            errors += 1
+        latencies.append(perf_counter() - command_start)
+    elapsed = perf_counter() - start
+
+    return {
+        "commands": len(latencies),
+        "errors": errors,
+        "elapsed_s": elapsed,
+        "latencies_s": latencies,
+        "mismatches": replay.mismatches,
+    }
@@ -0,0 +1,228 @@
+import numpy as np
+from math import pi
+from time import monotonic
+from .robot_object import trapezoid_duration
+from .protocol_program import MAX_PROGRAM_SIZE, OP_ASPIRATE, OP_DISPENSE, OP_EJECT, OP_MOVE, OP_WAIT, OP_ZERO, decode_program
+
+def trapezoid_position(t: np.ndarray, distance: float, speed: float, acceleration: float) -> tuple[np.ndarray, np.ndarray]:
+    # Position (steps) and velocity (steps/s) along the move at times t, short moves never reach full speed
+    peak = min(speed, np.sqrt(acceleration * distance))
+    ramp_time = peak / acceleration
+    total_time = distance / peak + ramp_time
+    t = np.clip(t, 0.0, total_time)
+    remaining = total_time - t
+    position = np.where(t < ramp_time, 0.5 * acceleration * t**2,
+               np.where(remaining < ramp_time, distance - 0.5 * acceleration * remaining**2,
+                        0.5 * peak * ramp_time + peak * (t - ramp_time)))
+    velocity = np.where(t < ramp_time, acceleration * t, np.where(remaining < ramp_time, acceleration * remaining, peak))
+    return position, velocity
+
+class SimulatedSerial:
+    # Serial-like stand-in for the ESP32 running serial_comms.ino, with N pipette channels
+    def __init__(self, num_channels: int = 1, realtime: bool = False, stepper_pipet_microsteps: int = 8, pipet_lead: float = 1,
+                 volume_to_travel_ratio: float = 2.39**2*pi, acceleration: float = 1000, disconnect_rate: float = 0.0,
+                 malformed_rate: float = 0.0, seed: int | None = None) -> None:
+        self.num_channels = num_channels
+        self.realtime = realtime # True answers after the simulated move finished, False answers immediately
+
+        # Fault injection, probability per command
+        self.disconnect_rate = disconnect_rate # The port drops and has to be reopened
+        self.malformed_rate = malformed_rate   # The reply gets truncated
+        self.rng = np.random.default_rng(seed)
+
+        # Same parameters and defaults as the firmware config.h
+        self.stepper_pipet_microsteps = stepper_pipet_microsteps
+        self.pipet_lead = pipet_lead #mm/rev
+        self.volume_to_travel_ratio = volume_to_travel_ratio #ul/mm
+        self.acceleration = acceleration #steps/s^2
+        self.calibration_offset = 0.0 #ul
+        self.telemetry_interval = 0 #ms
+        self.program = b""
+
+        self.positions = np.zeros(num_channels, dtype=np.int64) #steps
+        self.boot_time = monotonic()
+        self.busy_until = self.boot_time # The firmware blocks while moving, later commands wait
+        self.pending: list[tuple[float, bytes]] = [(self.boot_time, b"Serial started\r\n")]
+        self.motion_time = 0.0 #s of simulated motion, useful for throughput numbers
+        self.is_open = True
+
+    # Serial interface
+    def ready(self) -> int:
+        now = monotonic()
+        count = 0
+        while count < len(self.pending) and self.pending[count][0] <= now:
+            count += 1
+        return count
+
+    @property
+    def in_waiting(self) -> int:
+        return sum(len(data) for _, data in self.pending[:self.ready()])
+
+    def write(self, data: bytes) -> int:
+        if not self.is_open:
+            raise OSError("Simulated device is disconnected")
+        if self.disconnect_rate > 0 and self.rng.random() < self.disconnect_rate:
+            self.is_open = False
+            self.pending.clear()
+            raise OSError("Simulated device disconnected")
+        now = monotonic()
+        start = max(now, self.busy_until) if self.realtime else now
+        response, duration, streamed = self.execute_command(data.decode("utf-8", "ignore").strip())
+        if self.malformed_rate > 0 and self.rng.random() < self.malformed_rate:
+            response = response[:int(self.rng.integers(1, len(response)))]
+        self.motion_time += duration
+        if self.realtime:
+            self.busy_until = start + duration
+        for offset, line in streamed:
+            self.pending.append((start + offset if self.realtime else now, line.encode("utf-8") + b"\r\n"))
+        self.pending.append((start + duration if self.realtime else now, response.encode("utf-8") + b"\r\n"))
+        return len(data)
+
+    def readline(self) -> bytes:
+        if self.ready() == 0:
+            return b""
+        return self.pending.pop(0)[1]
+
+    def read_all(self) -> bytes:
+        ready = self.ready()
+        data = b"".join(data for _, data in self.pending[:ready])
+        del self.pending[:ready]
+        return data
+
+    def flush(self) -> None:
+        if not self.is_open:
+            raise OSError("Simulated device is disconnected")
+
+    def open(self) -> None:
+        self.is_open = True
+
+    def close(self) -> None:
+        self.is_open = False
+
+    # Firmware behaviour
+    def parse_channel_values(self, values: str) -> np.ndarray | None:
+        try:
+            parsed = np.array([float(value) for value in values.split(",")])
+        except ValueError:
+            return None
+        if parsed.size == 1:
+            return np.full(self.num_channels, parsed[0])
+        return parsed if parsed.size == self.num_channels else None
+
+    def execute_command(self, data: str) -> tuple[str, float, list[tuple[float, str]]]:
+        # Returns the JSON reply, the duration in s and the lines streamed before the reply with their offsets in s
+        if data.startswith("A") or data.startswith("D"):
+            volumes = self.parse_channel_values(data[1:data.find("R")].strip())
+            rates = self.parse_channel_values(data[data.find("R") + 1:].strip())
+            if volumes is None or rates is None:
+                return f'{{"status":"error","message":"Expected 1 or {self.num_channels} values {data}"}}', 0.0, []
+            return self.move(data.startswith("A"), volumes, rates)
+        elif data.startswith("M"):
+            steps = self.parse_channel_values(data[1:data.find("R")].strip())
+            speeds = self.parse_channel_values(data[data.find("R") + 1:].strip())
+            if steps is None or speeds is None:
+                return f'{{"status":"error","message":"Expected 1 or {self.num_channels} values {data}"}}', 0.0, []
+            return self.move_steps(steps.astype(np.int64), speeds, "Moved")
+        elif data.startswith("U"):
+            try:
+                program = bytes.fromhex(data[1:])
+            except ValueError:
+                return '{"status":"error","message":"Invalid program"}', 0.0, []
+            if len(program) > MAX_PROGRAM_SIZE:
+                return f'{{"status":"error","message":"Program too large {len(program)} bytes"}}', 0.0, []
+            self.program = program
+            return f'{{"status":"success","message":"Program uploaded {len(program)} bytes"}}', 0.0, []
+        elif data == "X":
+            if not self.program:
+                return '{"status":"error","message":"No program uploaded"}', 0.0, []
+            return self.run_program()
+        elif data == "E":
+            return '{"status":"success","message":"Tip Ejected"}', 0.0, []
+        elif data.startswith("S"):
+            try:
+                microsteps = int(data[1:data.find("L")].strip() or 0)
+                lead = float(data[data.find("L") + 1:data.find("V")].strip() or 0)
+                volume_tt_ratio = float(data[data.find("V") + 1:].strip() or 0)
+            except ValueError:
+                microsteps, lead, volume_tt_ratio = 0, 0, 0
+            if microsteps > 0: self.stepper_pipet_microsteps = microsteps
+            if lead > 0: self.pipet_lead = lead
+            if volume_tt_ratio > 0: self.volume_to_travel_ratio = volume_tt_ratio
+            return (f'{{"status":"success","message":"Microsteps {self.stepper_pipet_microsteps} Lead {self.pipet_lead:.2f}mm/rev '
+                    f'Volume to travel ratio {self.volume_to_travel_ratio:.2f} ul/mm"}}'), 0.0, []
+        elif data == "Ping":
+            return f'{{"status":"success","message":"pong","channels":{self.num_channels}}}', 0.0, []
+        elif data == "Z":
+            self.positions[:] = 0
+            return '{"status":"success","message":"Robot zeroed"}', 0.0, []
+        elif data.startswith("T"):
+            try:
+                self.telemetry_interval = int(data[1:])
+            except ValueError:
+                self.telemetry_interval = 0
+            return f'{{"status":"success","message":"Telemetry interval {self.telemetry_interval} ms"}}', 0.0, []
+        elif data.startswith("O"):
+            try:
+                self.calibration_offset = float(data[1:])
+            except ValueError:
+                self.calibration_offset = 0.0
+            return f'{{"status":"success","message":"Volume offset set to {self.calibration_offset:.2f} ul"}}', 0.0, []
+        return f'{{"status":"error","message":"No valid parameters given {data}"}}', 0.0, []
+
+    def run_program(self) -> tuple[str, float, list[tuple[float, str]]]:
+        # Runs the uploaded bytecode like the firmware interpreter, one completion event per instruction
+        try:
+            instructions = decode_program(self.program)
+        except Exception:
+            return '{"status":"error","message":"Program ended without end instruction"}', 0.0, []
+        elapsed = 0.0
+        streamed = []
+        for step, (opcode, *operands) in enumerate(instructions):
+            duration = 0.0
+            lines = []
+            result = '{"status":"success"}'
+            if opcode in (OP_ASPIRATE, OP_DISPENSE):
+                result, duration, lines = self.move(opcode == OP_ASPIRATE, np.full(self.num_channels, operands[0]), np.full(self.num_channels, operands[1]))
+            elif opcode == OP_MOVE:
+                result, duration, lines = self.move_steps(np.full(self.num_channels, operands[0], dtype=np.int64), np.full(self.num_channels, operands[1]), "Moved")
+            elif opcode == OP_ZERO:
+                self.positions[:] = 0
+            elif opcode == OP_WAIT:
+                duration = operands[0] / 1000
+            elif opcode != OP_EJECT:
+                result = f'{{"status":"error","message":"Unknown opcode {opcode}"}}'
+            streamed += [(elapsed + offset, line) for offset, line in lines]
+            elapsed += duration
+            success = '"error"' not in result
+            streamed.append((elapsed, f"P{step},{1 if success else 0}"))
+            if not success:
+                return f'{{"status":"error","message":"Program failed at step {step}"}}', elapsed, streamed
+        return f'{{"status":"success","message":"Program completed {len(instructions)} steps"}}', elapsed, streamed
+
+    def move(self, aspirate: bool, volumes: np.ndarray, rates: np.ndarray) -> tuple[str, float, list[tuple[float, str]]]:
+        steps_per_rev = 200 * self.stepper_pipet_microsteps
+        direction = -1 if aspirate else 1
+        steps = np.round(direction * volumes / self.volume_to_travel_ratio / self.pipet_lead * steps_per_rev).astype(np.int64)
+        speeds = rates / self.volume_to_travel_ratio / self.pipet_lead * steps_per_rev
+        return self.move_steps(steps, speeds, "Aspirated" if aspirate else "Dispensed")
+
+    def move_steps(self, steps: np.ndarray, speeds: np.ndarray, action: str) -> tuple[str, float, list[tuple[float, str]]]:
+        steps_per_rev = 200 * self.stepper_pipet_microsteps
+        rps = speeds / steps_per_rev
+        durations = trapezoid_duration(steps, speeds, self.acceleration)
+        duration = float(durations.max(initial=0.0))
+
+        telemetry = []
+        if self.telemetry_interval > 0 and duration > 0 and steps[0] != 0 and speeds[0] > 0:
+            # Samples of the first channel, like the firmware
+            direction = 1 if steps[0] > 0 else -1
+            offsets = np.arange(self.telemetry_interval, duration * 1000, self.telemetry_interval) / 1000
+            position, velocity = trapezoid_position(offsets, abs(steps[0]), speeds[0], self.acceleration)
+            boot_ms = (monotonic() - self.boot_time) * 1000
+            for offset, sample_position, sample_velocity in zip(offsets, position, velocity):
+                telemetry.append((offset, f"T{int(boot_ms + offset * 1000)},{int(self.positions[0] + direction * sample_position)},{direction * sample_velocity:.1f}"))
+
+        self.positions += steps
+        step_list = ",".join(str(step) for step in steps)
+        rps_list = ",".join(f"{value:.2f}" for value in rps)
+        return f'{{"status":"success", "message": "{action} {step_list} steps at {rps_list} rps"}}', duration, telemetry
@@ -0,0 +1,89 @@
+import threading
+from math import ceil
+import numpy as np
+
+class TelemetryBuffer:
+    # Column layout of the ring buffer
+    TIME = 0        # ms since device boot
+    POSITION = 1    # steps
+    VELOCITY = 2    # steps/s
+
+    # Longest line the device sends, "T<ms>,<position>,<velocity>" plus CR LF
+    MAX_LINE_BYTES = 36
+    # Share of the serial link telemetry may use, the rest is left for command replies and program events
+    MAX_LINK_SHARE = 0.5
+
+    def __init__(self, capacity: int = 10000, downsample: int = 1) -> None:
+        if capacity <= 0:
+            raise Exception("Telemetry capacity must be positive")
+        if downsample <= 0:
+            raise Exception("Telemetry downsample factor must be positive")
+        self.capacity = capacity
+        self.downsample = downsample
+
+        # Preallocated once, samples are written in place so the serial thread never allocates
+        self.samples = np.zeros((capacity, 3), dtype=np.float64)
+        self.head = 0           # next write index
+        self.count = 0          # valid samples in the buffer
+        self.received = 0       # samples received from the device, including skipped ones
+        self.lock = threading.Lock()
+
+    @classmethod
+    def min_interval(cls, baud_rate: int) -> int:
+        # ms between samples so the stream fits its share of the link, 10 bits per byte with start and stop bit
+        return ceil(cls.MAX_LINE_BYTES * 10 * 1000 / (baud_rate * cls.MAX_LINK_SHARE))
+
+    @staticmethod
+    def is_telemetry_line(line: str) -> bool:
+        return line.startswith("T")
+
+    def parse_line(self, line: str) -> bool:
+        # Telemetry lines look like "T<ms>,<position>,<velocity>"
+        if not self.is_telemetry_line(line):
+            return False
+        try:
+            timestamp, position, velocity = line[1:].split(",")
+            self.append(float(timestamp), float(position), float(velocity))
+        except ValueError:
+            pass # Malformed samples are dropped, they must never break the command path
+        return True
+
+    def append(self, timestamp: float, position: float, velocity: float) -> None:
+        with self.lock:
+            self.received += 1
+            if (self.received - 1) % self.downsample != 0:
+                return
+            row = self.samples[self.head]
+            row[self.TIME] = timestamp
+            row[self.POSITION] = position
+            row[self.VELOCITY] = velocity
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def get_samples(self, last: int = 0, since: float | None = None) -> np.ndarray:
+        # Returns a chronologically ordered copy, shape (n, 3)
+        with self.lock:
+            start = (self.head - self.count) % self.capacity
+            if start + self.count <= self.capacity:
+                ordered = self.samples[start:start + self.count].copy()
+            else:
+                ordered = np.concatenate((self.samples[start:], self.samples[:self.head]))
+        if since is not None:
+            ordered = ordered[ordered[:, self.TIME] > since]
+        if last > 0:
+            ordered = ordered[-last:]
+        return ordered
+
+    def as_dict(self, last: int = 0, since: float | None = None) -> dict[str, list[float]]:
+        samples = self.get_samples(last=last, since=since)
+        return {
+            "time_ms": samples[:, self.TIME].tolist(),
+            "position_steps": samples[:, self.POSITION].tolist(),
+            "velocity_steps_per_s": samples[:, self.VELOCITY].tolist(),
+        }
+
+    def clear(self) -> None:
+        with self.lock:
+            self.head = 0
+            self.count = 0
+            self.received = 0
@@ -0,0 +1,125 @@
+import json
+import os
+import re
+from datetime import datetime
+import numpy as np
+
+WATER_DENSITY = 0.9982 # mg/ul at 20 degC
+
+class CalibrationProfile:
+    # Continuous piecewise linear model of the pipette: delivered volume at every range edge, linear in between
+    def __init__(self, range_edges: list[float], delivered_volumes: list[float], version: int = 0,
+                 created: str = "", description: str = "") -> None:
+        self.range_edges = np.asarray(range_edges, dtype=np.float64) #ul commanded
+        self.delivered_volumes = np.asarray(delivered_volumes, dtype=np.float64) #ul delivered
+        if self.range_edges.size < 2 or self.range_edges.size != self.delivered_volumes.size:
+            raise Exception("Calibration profile needs a delivered volume for every range edge")
+        if np.any(np.diff(self.range_edges) <= 0) or np.any(np.diff(self.delivered_volumes) <= 0):
+            raise Exception("Calibration profile must be strictly increasing")
+        self.version = version
+        self.created = created or datetime.now().isoformat(timespec="seconds")
+        self.description = description
+
+    @classmethod
+    def identity(cls, max_volume: float = 1000) -> "CalibrationProfile":
+        return cls([0, max_volume], [0, max_volume], description="Identity")
+
+    @property
+    def slopes(self) -> np.ndarray:
+        return np.diff(self.delivered_volumes) / np.diff(self.range_edges)
+
+    def delivered_volume(self, commanded_volumes) -> np.ndarray:
+        return np.interp(commanded_volumes, self.range_edges, self.delivered_volumes)
+
+    def commanded_volume(self, target_volumes) -> np.ndarray:
+        # Exact inverse of the model: what to command to deliver the target volume, nothing for nothing
+        target_volumes = np.asarray(target_volumes, dtype=np.float64)
+        return np.where(target_volumes > 0, np.interp(target_volumes, self.delivered_volumes, self.range_edges), 0.0)
+
+    def to_dict(self) -> dict:
+        return {
+            "version": self.version,
+            "created": self.created,
+            "description": self.description,
+            "range_edges": self.range_edges.tolist(),
+            "delivered_volumes": self.delivered_volumes.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CalibrationProfile":
+        return cls(data["range_edges"], data["delivered_volumes"], version=data.get("version", 0),
+                   created=data.get("created", ""), description=data.get("description", ""))
+
+def fit_calibration(commanded_volumes, measured_masses, range_edges: list[float], density: float = WATER_DENSITY,
+                    description: str = "") -> CalibrationProfile:
+    # Gravimetric fit: one least squares solve for a line per range that stays continuous at the range edges
+    commanded = np.asarray(commanded_volumes, dtype=np.float64)
+    delivered = np.asarray(measured_masses, dtype=np.float64) / density #ul
+    range_edges = np.asarray(range_edges, dtype=np.float64)
+
+    counts = np.bincount(np.clip(np.searchsorted(range_edges, commanded, side="right") - 1, 0, range_edges.size - 2),
+                         minlength=range_edges.size - 1)
+    if np.any(counts < 2):
+        raise Exception(f"Every calibration range needs at least 2 measurements, got {counts.tolist()}")
+
+    # Hinge basis: offset, slope, and a slope change at every inner edge
+    def basis(volumes: np.ndarray) -> np.ndarray:
+        return np.column_stack([np.ones_like(volumes), volumes] + [np.maximum(volumes - edge, 0.0) for edge in range_edges[1:-1]])
+
+    coefficients, _, rank, _ = np.linalg.lstsq(basis(commanded), delivered, rcond=None)
+    if rank < range_edges.size:
+        raise Exception("Every calibration range needs measurements at more than one volume")
+    return CalibrationProfile(range_edges, basis(range_edges) @ coefficients, description=description)
+
+class VolumeLookupTable:
+    # Precomputed target volume -> step count table for one profile and one set of pipette mechanics
+    def __init__(self, profile: CalibrationProfile, steps_per_ul: float, max_volume: float | None = None, resolution: float = 0.1) -> None:
+        self.profile = profile
+        self.steps_per_ul = steps_per_ul
+        # np.interp clamps past the last calibrated volume, so the table never reaches beyond it
+        calibrated_volume = float(profile.delivered_volumes[-1])
+        if max_volume is not None and max_volume > calibrated_volume:
+            raise Exception(f"Calibration profile only covers 0 - {calibrated_volume:.2f} ul, not {max_volume} ul")
+        self.max_volume = float(max_volume if max_volume is not None else calibrated_volume) #ul
+        self.resolution = resolution #ul between table entries
+        self.volumes = np.arange(0.0, self.max_volume + resolution, resolution)
+        self.steps = profile.commanded_volume(self.volumes) * steps_per_ul # Fractional, rounded after interpolation
+
+    def volume_to_steps(self, volumes) -> np.ndarray:
+        volumes = np.asarray(volumes, dtype=np.float64)
+        if np.any(volumes < 0) or np.any(volumes > self.max_volume):
+            raise Exception(f"Volume outside of the calibrated range 0 - {self.max_volume} ul")
+        return np.rint(np.interp(volumes, self.volumes, self.steps)).astype(np.int64)
+
+class CalibrationStore:
+    # Versioned profiles on disk, one JSON file per version
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, version: int) -> str:
+        return os.path.join(self.directory, f"calibration_v{version:04d}.json")
+
+    def list_versions(self) -> list[int]:
+        versions = []
+        for filename in os.listdir(self.directory):
+            match = re.fullmatch(r"calibration_v(\d+)\.json", filename)
+            if match:
+                versions.append(int(match.group(1)))
+        return sorted(versions)
+
+    def save(self, profile: CalibrationProfile) -> int:
+        versions = self.list_versions()
+        profile.version = versions[-1] + 1 if versions else 1
+        with open(self.path(profile.version), "x") as profile_file:
+            json.dump(profile.to_dict(), profile_file, indent=2)
+        return profile.version
+
+    def load(self, version: int | None = None) -> CalibrationProfile:
+        if version is None:
+            versions = self.list_versions()
+            if not versions:
+                raise Exception(f"No calibration profiles in {self.directory}")
+            version = versions[-1]
+        with open(self.path(version)) as profile_file:
+            return CalibrationProfile.from_dict(json.load(profile_file))
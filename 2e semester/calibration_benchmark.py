@@ -0,0 +1,51 @@
+import argparse
+import tempfile
+from math import pi
+from time import perf_counter
+import numpy as np
+from PythonServer_Package.volume_calibration import CalibrationStore, VolumeLookupTable, fit_calibration
+
+# Fits a calibration from synthetic gravimetric data and converts a large protocol to step counts
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark batch volume to step conversion")
+    parser.add_argument("--volumes", type=int, default=1_000_000, help="Number of transfers in the protocol")
+    parser.add_argument("--max-volume", type=float, default=1000, help="Largest volume in ul")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    steps_per_ul = 200 * 8 / ((4/2)**2*pi * 1) # Same mechanics as RobotObject
+
+    # Synthetic gravimetric run: 10 repeats at 40 volumes, the pipette under-delivers small volumes
+    commanded = np.repeat(np.linspace(5, args.max_volume, 40), 10)
+    delivered = commanded * (0.97 + 0.02 * commanded / args.max_volume) - 1.5 + rng.normal(0, 0.3, commanded.size)
+    masses = delivered * 0.9982
+
+    start = perf_counter()
+    profile = fit_calibration(commanded, masses, [0, 50, 200, args.max_volume], description="Synthetic benchmark")
+    fit_time = perf_counter() - start
+
+    store = CalibrationStore(tempfile.mkdtemp())
+    version = store.save(profile)
+    profile = store.load(version)
+
+    start = perf_counter()
+    table = VolumeLookupTable(profile, steps_per_ul) # Up to the largest calibrated volume
+    table_time = perf_counter() - start
+
+    protocol = rng.uniform(1, table.max_volume, args.volumes)
+    start = perf_counter()
+    steps = table.volume_to_steps(protocol)
+    batch_time = perf_counter() - start
+
+    # Per-transfer float math, like the firmware and the old per-command path
+    sample = protocol[:min(args.volumes, 100_000)]
+    start = perf_counter()
+    for volume in sample:
+        round(float(profile.commanded_volume(volume)) * steps_per_ul)
+    loop_time = (perf_counter() - start) * args.volumes / sample.size
+
+    print(f"Fitted profile v{version} over {profile.slopes.size} ranges in {fit_time*1000:.2f}ms")
+    print(f"Lookup table with {table.volumes.size} entries built in {table_time*1000:.2f}ms")
+    print(f"Batch conversion of {args.volumes} volumes: {batch_time*1000:.1f}ms ({args.volumes/batch_time/1e6:.1f}M volumes/s)")
+    print(f"Per-transfer conversion (extrapolated): {loop_time*1000:.1f}ms, {loop_time/batch_time:.0f}x slower")
+    print(f"Largest table rounding error: {np.max(np.abs(steps - profile.commanded_volume(protocol) * steps_per_ul)):.2f} steps")
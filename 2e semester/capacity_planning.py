@@ -0,0 +1,48 @@
+import argparse
+import json
+from time import perf_counter
+from PythonServer_Package.fleet_simulator import DEFAULT_WORKLOAD, simulate_fleet
+
+# Simulates hours of fleet operation in seconds to find where throughput saturates
+# Workload file example: {"robots": 2, "clients": 6, "arrival_rate": 0.05, "volume": [10, 200], "refill_volume": 5000}
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Discrete-event capacity planning for a fleet of pipette robots")
+    parser.add_argument("workload", nargs="?", help="JSON workload description, missing keys use the defaults")
+    parser.add_argument("--robots", type=int)
+    parser.add_argument("--clients", type=int)
+    parser.add_argument("--arrival-rate", type=float, help="Transfers/s per client while idle, 1 / mean think time between transfers")
+    parser.add_argument("--hours", type=float)
+    parser.add_argument("--sweep", type=float, nargs="+", help="Arrival rate multipliers to run one after the other")
+    parser.add_argument("--json", help="Write the full reports to this file")
+    args = parser.parse_args()
+
+    workload = dict(DEFAULT_WORKLOAD)
+    if args.workload:
+        with open(args.workload) as workload_file:
+            workload.update(json.load(workload_file))
+    for key in ("robots", "clients", "arrival_rate", "hours"):
+        if getattr(args, key) is not None:
+            workload[key] = getattr(args, key)
+
+    reports = []
+    for multiplier in args.sweep or [1.0]:
+        start = perf_counter()
+        report = simulate_fleet({**workload, "arrival_rate": workload["arrival_rate"] * multiplier})
+        elapsed = perf_counter() - start
+        reports.append({"arrival_rate": workload["arrival_rate"] * multiplier, **report})
+
+        print(f"\n{report['hours']:.1f}h with {workload['robots']} robots, {workload['clients']} clients at "
+              f"{workload['arrival_rate'] * multiplier:.4f} /s think rate each, simulated in {elapsed:.2f}s")
+        print(f"{'robot':>5} {'clients':>7} {'xfer/h':>8} {'util':>6} {'motion':>6} {'serial':>6} {'refill':>6} "
+              f"{'queue':>6} {'maxq':>5} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'429':>6} {'503':>6} {'failed':>6}  bottleneck")
+        for robot in report["robots"]:
+            latency = robot["transfer_latency"]
+            print(f"{robot['robot']:>5} {robot['clients']:>7} {robot['transfers_per_hour']:>8.1f} {robot['utilization']:>6.1%} "
+                  f"{robot['motion_utilization']:>6.1%} {robot['serial_utilization']:>6.1%} {robot['refill_utilization']:>6.1%} "
+                  f"{robot['mean_queue']:>6.2f} {robot['max_queue']:>5} {latency['p50']:>8.2f} {latency['p95']:>8.2f} {latency['p99']:>8.2f} "
+                  f"{robot['rejected_client_limit']:>6} {robot['rejected_queue_full']:>6} {robot['failed_transfers']:>6}  {robot['bottleneck']}")
+
+    if args.json:
+        with open(args.json, "w") as report_file:
+            json.dump(reports, report_file, indent=2)
+        print(f"\nReports written to {args.json}")
@@ -0,0 +1,44 @@
+import argparse
+import tempfile
+from statistics import mean
+from PythonServer_Package import RobotObject
+from PythonServer_Package.serial_session import SerialRecorder, SerialReplay, diff_sessions, recorded_commands, replay_session
+
+# Replays a recorded serial session through RobotObject, without hardware
+# Record one on the real robot with robot.start_recording("session.rss") ... robot.stop_recording()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the host stack against a recorded serial session")
+    parser.add_argument("session", help="Recorded serial session file")
+    parser.add_argument("--realtime", action="store_true", help="Answer at the recorded device speed instead of as fast as possible")
+    parser.add_argument("--record", help="Record the host behaviour during the replay to this file")
+    parser.add_argument("--diff", help="Compare the recorded replay against another session file")
+    args = parser.parse_args()
+
+    robot = RobotObject()
+    robot.setup_logging(tempfile.gettempdir())
+    result = replay_session(robot, args.session, realtime=args.realtime)
+    latencies = sorted(result["latencies_s"])
+
+    print(f"Commands replayed: {result['commands']} ({result['errors']} errors) in {result['elapsed_s']:.3f}s")
+    if latencies:
+        print(f"Latency mean {mean(latencies)*1000:.3f}ms, p50 {latencies[len(latencies)//2]*1000:.3f}ms, max {latencies[-1]*1000:.3f}ms")
+    for index, expected, actual in result["mismatches"]:
+        print(f"Write mismatch at event {index}: recorded {expected!r}, sent {actual!r}")
+
+    if args.record:
+        # Second pass with a recorder around the replay device, so runs of different commits can be diffed
+        recorder = SerialRecorder(SerialReplay(args.session, realtime=False), args.record)
+        robot.ser = recorder
+        for command in recorded_commands(args.session):
+            try:
+                robot.send_command(command, print_confirmation=False)
+            except Exception:
+                pass
+        recorder.stop()
+        print(f"Replay recorded to {args.record}")
+
+        if args.diff:
+            differences = diff_sessions(args.diff, args.record)
+            print(f"{len(differences)} differences against {args.diff}")
+            for difference in differences:
+                print(difference)
@@ -8,8 +8,14 @@
 #define SAFETY_CHECKS_ENABLED false
 #define INVERT_DIRECTION false
 
+#define NUM_CHANNELS 1 // Pipette channels, one stepper each
+#define DIR_PINS {22}  // One pin per channel, e.g. {22, 18, ...} for more channels
+#define STEP_PINS {23}
+
 #define STEPPER_PIPET_MICROSTEPS_CONFIG 8 //microsteps
 #define LEAD_CONFIG 1 // mm/rev
+#define MAX_PROGRAM_SIZE 1024 // bytes of uploaded protocol program
+#define TELEMETRY_INTERVAL_MS_CONFIG 0 // ms between motion samples, 0 = disabled
 #define VOLUME_TO_TRAVEL_RATIO_CONFIG float(sq(2.39)*3.14159) // ul/mm
 //(4mm/2)^2*pi *diameter = 4mm
 // => 1000ul = 79.58mm
@@ -1,13 +1,13 @@
 #include <ESP_FlexyStepper.h>
 #include "config.h"
 
-const int dirPin = 22;
-const int stepPin = 23;
+const int dirPins[NUM_CHANNELS] = DIR_PINS;   // One driver per channel
+const int stepPins[NUM_CHANNELS] = STEP_PINS;
 const int enablePin = 7;
 const int limitSwitchMin = 8;  // Minimum limit switch pin
 const int limitSwitchMax = 9;  // Maximum limit switch pin
 
-ESP_FlexyStepper stepper;
+ESP_FlexyStepper steppers[NUM_CHANNELS];
 
 int STEPPER_PIPET_MICROSTEPS = STEPPER_PIPET_MICROSTEPS_CONFIG; // Microsteps
 float LEAD = LEAD_CONFIG;               // mm/rev
@@ -15,6 +15,32 @@ float VOLUME_TO_TRAVEL_RATIO = VOLUME_TO_TRAVEL_RATIO_CONFIG; // ul/mm
 
 String DEBUG_INFO = "";
 
+unsigned long TELEMETRY_INTERVAL_MS = TELEMETRY_INTERVAL_MS_CONFIG; // 0 = telemetry disabled
+unsigned long lastTelemetryTime = 0;
+
+// Uploaded protocol program, see PythonServer_Package/protocol_program.py for the bytecode
+#define OP_END 0x00
+#define OP_ASPIRATE 0x01
+#define OP_DISPENSE 0x02
+#define OP_EJECT 0x03
+#define OP_ZERO 0x04
+#define OP_WAIT 0x05
+#define OP_MOVE 0x06
+
+uint8_t program[MAX_PROGRAM_SIZE];
+int programLength = 0;
+int programCounter = 0;  // Byte offset of the next instruction
+int programStep = 0;     // Index of the next instruction, reported in the completion events
+bool programRunning = false;
+unsigned long programWaitStarted = 0;
+unsigned long programWaitMs = 0;
+bool programWaiting = false;
+
+// A move is started by a command and driven from loop(), its reply is sent once every channel arrived
+bool moveActive = false;
+String moveReply = "";
+String moveFailedReply = "";
+
 // Volatile flags for limit switches, set by their interrupt routines
 volatile bool limitSwitchMinTriggered = false;
 volatile bool limitSwitchMaxTriggered = false;
@@ -46,40 +72,102 @@ void setup() {
   attachInterrupt(digitalPinToInterrupt(limitSwitchMax), limitSwitchMaxISR, FALLING);
   */
   if (USE_STEPPER_MOTOR) {
-    stepper.connectToPins(stepPin, dirPin);
-    stepper.setStepsPerRevolution(200 * STEPPER_PIPET_MICROSTEPS);
-    stepper.setSpeedInStepsPerSecond(1600);  // Default speed (steps per second)
-    stepper.setAccelerationInStepsPerSecondPerSecond(1000);
-    stepper.setDecelerationInStepsPerSecondPerSecond(1000);
+    for (int channel = 0; channel < NUM_CHANNELS; channel++) {
+      steppers[channel].connectToPins(stepPins[channel], dirPins[channel]);
+      steppers[channel].setStepsPerRevolution(200 * STEPPER_PIPET_MICROSTEPS);
+      steppers[channel].setSpeedInStepsPerSecond(1600);  // Default speed (steps per second)
+      steppers[channel].setAccelerationInStepsPerSecondPerSecond(1000);
+      steppers[channel].setDecelerationInStepsPerSecondPerSecond(1000);
+    }
   }
 }
 
 void loop() {
   if (Serial.available() > 0) {
     String command_str = Serial.readStringUntil('\n');
-    String response = execute_command(command_str);
-    if (ENABLE_DEBUG) {
-      response = response.substring(0, response.length() - 1);
-      response += ", \"debug_info\":\"" + DEBUG_INFO + "\"}";
+    String response;
+    if (programRunning) response = "{\"status\":\"error\",\"message\":\"Program running\"}";
+    else if (moveActive) response = "{\"status\":\"error\",\"message\":\"Robot moving\"}";
+    else response = execute_command(command_str);
+    // Moves and programs have no immediate reply, the result follows when they end
+    if (response.length() > 0) {
+      sendReply(response);
     }
-    Serial.println(response);
   }
-  
+
   // Continuously update the stepper movement
-  stepper.processMovement();
+  for (int channel = 0; channel < NUM_CHANNELS; channel++) {
+    steppers[channel].processMovement();
+  }
+
+  if (moveActive) {
+    serviceMove();
+  }
+  else if (programRunning) {
+    runProgramStep();
+  }
+}
+
+void sendReply(String response) {
+  if (ENABLE_DEBUG) {
+    response = response.substring(0, response.length() - 1);
+    response += ", \"debug_info\":\"" + DEBUG_INFO + "\"}";
+  }
+  Serial.println(response);
 }
 
 String execute_command(String data) {
-  if (data.indexOf("A") == 0) {
-    float aspiration_volume = data.substring(1, data.indexOf("R") - 1).toFloat();
-    float aspiration_rate = data.substring(data.indexOf("R") + 1, data.length()).toFloat();
-    return aspirate(aspiration_volume, aspiration_rate);
-  } 
-  else if (data.indexOf("D") == 0) {
-    float dispense_volume = data.substring(1, data.indexOf("R") - 1).toFloat();
-    float dispense_rate = data.substring(data.indexOf("R") + 1, data.length()).toFloat();
-    return dispense(dispense_volume, dispense_rate);
+  if (data.indexOf("A") == 0 || data.indexOf("D") == 0) {
+    // "A<v> R<r>" broadcasts to every channel, "A<v1>,<v2>,... R<r1>,<r2>,..." is per channel
+    float volumes[NUM_CHANNELS];
+    float rates[NUM_CHANNELS];
+    if (!parseChannelValues(data.substring(1, data.indexOf("R") - 1), volumes) ||
+        !parseChannelValues(data.substring(data.indexOf("R") + 1, data.length()), rates)) {
+      return "{\"status\":\"error\",\"message\":\"Expected 1 or " + String(NUM_CHANNELS) + " values " + String(data) + "\"}";
+    }
+    if (data.indexOf("A") == 0) return aspirate(volumes, rates);
+    return dispense(volumes, rates);
   } 
+  else if (data.indexOf("M") == 0) {
+    // "M<steps> R<steps/s>": exact step counts from the host calibration table, signed like aspirate/dispense
+    float steps[NUM_CHANNELS];
+    float speeds[NUM_CHANNELS];
+    if (!parseChannelValues(data.substring(1, data.indexOf("R") - 1), steps) ||
+        !parseChannelValues(data.substring(data.indexOf("R") + 1, data.length()), speeds)) {
+      return "{\"status\":\"error\",\"message\":\"Expected 1 or " + String(NUM_CHANNELS) + " values " + String(data) + "\"}";
+    }
+    return moveSteps(steps, speeds);
+  }
+  else if (data.indexOf("U") == 0) {
+    // "U<hex>": uploads a program, two hex characters per byte
+    int length = (data.length() - 1) / 2;
+    if (length > MAX_PROGRAM_SIZE) {
+      return "{\"status\":\"error\",\"message\":\"Program too large " + String(length) + " bytes\"}";
+    }
+    // A corrupt upload is refused whole, the previous program stays
+    if ((data.length() - 1) % 2 != 0) {
+      return "{\"status\":\"error\",\"message\":\"Invalid program, odd number of hex characters\"}";
+    }
+    for (unsigned int i = 1; i < data.length(); i++) {
+      if (!isxdigit(data.charAt(i))) {
+        return "{\"status\":\"error\",\"message\":\"Invalid program, bad hex character at " + String(i - 1) + "\"}";
+      }
+    }
+    for (int i = 0; i < length; i++) {
+      program[i] = strtoul(data.substring(1 + 2 * i, 3 + 2 * i).c_str(), NULL, 16);
+    }
+    programLength = length;
+    return "{\"status\":\"success\",\"message\":\"Program uploaded " + String(programLength) + " bytes\"}";
+  }
+  else if (data == "X") {
+    if (programLength == 0) {
+      return "{\"status\":\"error\",\"message\":\"No program uploaded\"}";
+    }
+    programCounter = 0;
+    programStep = 0;
+    programRunning = true;
+    return "";
+  }
   else if (data == "E") {
     return eject();
   } 
@@ -97,67 +185,263 @@ String execute_command(String data) {
            String(VOLUME_TO_TRAVEL_RATIO, 2) + " ul/mm\"}";
   } 
   else if (data == "Ping") {
-    return "{\"status\":\"success\",\"message\":\"pong\"}";
+    return "{\"status\":\"success\",\"message\":\"pong\",\"channels\":" + String(NUM_CHANNELS) + "}";
   } 
   else if (data == "Z") {
     return "{\"status\":\"success\",\"message\":\"Robot zeroed\"}";
   } 
+  else if (data.indexOf("T") == 0) {
+    TELEMETRY_INTERVAL_MS = data.substring(1, data.length()).toInt();
+    return "{\"status\":\"success\",\"message\":\"Telemetry interval " + String(TELEMETRY_INTERVAL_MS) + " ms\"}";
+  }
   else {
     return "{\"status\":\"error\",\"message\":\"No valid parameters given " + String(data) + "\"}";
   }
 }
 
-String aspirate(float aspiration_volume, float aspiration_rate) {
-  float travel = -aspiration_volume / VOLUME_TO_TRAVEL_RATIO;
-  float rotations = travel / LEAD;
-  int steps = round(rotations * 200 * STEPPER_PIPET_MICROSTEPS);
-  // Calculate speed in revolutions per second (rps) by removing the factor of 60
-  float rps = (aspiration_rate / VOLUME_TO_TRAVEL_RATIO) / LEAD;
+// Fills one value per channel, a single value is broadcast to all channels
+bool parseChannelValues(String list, float values[]) {
+  int count = 0;
+  int start = 0;
+  while (start <= (int)list.length()) {
+    int end = list.indexOf(",", start);
+    if (end == -1) end = list.length();
+    if (count >= NUM_CHANNELS) return false;
+    values[count++] = list.substring(start, end).toFloat();
+    start = end + 1;
+  }
+  if (count == 1) {
+    for (int channel = 1; channel < NUM_CHANNELS; channel++) values[channel] = values[0];
+    return true;
+  }
+  return count == NUM_CHANNELS;
+}
 
-  if (moveStepper(steps, rps)) {
-    return "{\"status\":\"success\", \"message\": \"Aspirated " + String(steps) + " steps at " + String(rps) + " rps\"}";
-  } else {
-    return "{\"status\":\"error\", \"message\": \"Failed to aspirate " + String(steps) + " steps at " + String(rps) + " rps\"}";
+String channelList(const int values[]) {
+  String list = String(values[0]);
+  for (int channel = 1; channel < NUM_CHANNELS; channel++) list += "," + String(values[channel]);
+  return list;
+}
+
+String channelList(const float values[]) {
+  String list = String(values[0]);
+  for (int channel = 1; channel < NUM_CHANNELS; channel++) list += "," + String(values[channel]);
+  return list;
+}
+
+String aspirate(float aspiration_volumes[], float aspiration_rates[]) {
+  int steps[NUM_CHANNELS];
+  float rps[NUM_CHANNELS];
+  for (int channel = 0; channel < NUM_CHANNELS; channel++) {
+    float travel = -aspiration_volumes[channel] / VOLUME_TO_TRAVEL_RATIO;
+    float rotations = travel / LEAD;
+    steps[channel] = round(rotations * 200 * STEPPER_PIPET_MICROSTEPS);
+    // Calculate speed in revolutions per second (rps) by removing the factor of 60
+    rps[channel] = (aspiration_rates[channel] / VOLUME_TO_TRAVEL_RATIO) / LEAD;
   }
+
+  return startMove(steps, rps,
+                   "{\"status\":\"success\", \"message\": \"Aspirated " + channelList(steps) + " steps at " + channelList(rps) + " rps\"}",
+                   "{\"status\":\"error\", \"message\": \"Failed to aspirate " + channelList(steps) + " steps at " + channelList(rps) + " rps\"}");
 }
 
-String dispense(float dispense_volume, float dispense_rate) {
-  float travel = dispense_volume / VOLUME_TO_TRAVEL_RATIO;
-  float rotations = travel / LEAD;
-  int steps = round(rotations * 200 * STEPPER_PIPET_MICROSTEPS);
-  // Calculate speed in revolutions per second (rps)
-  float rps = (dispense_rate / VOLUME_TO_TRAVEL_RATIO) / LEAD;
-  if (moveStepper(steps, rps)) {
-    return "{\"status\":\"success\", \"message\": \"Dispensed " + String(steps) + " steps at " + String(rps) + " rps\"}";
-  } else {
-    return "{\"status\":\"error\", \"message\": \"Failed to dispense " + String(steps) + " steps at " + String(rps) + " rps\"}";
+String dispense(float dispense_volumes[], float dispense_rates[]) {
+  int steps[NUM_CHANNELS];
+  float rps[NUM_CHANNELS];
+  for (int channel = 0; channel < NUM_CHANNELS; channel++) {
+    float travel = dispense_volumes[channel] / VOLUME_TO_TRAVEL_RATIO;
+    float rotations = travel / LEAD;
+    steps[channel] = round(rotations * 200 * STEPPER_PIPET_MICROSTEPS);
+    // Calculate speed in revolutions per second (rps)
+    rps[channel] = (dispense_rates[channel] / VOLUME_TO_TRAVEL_RATIO) / LEAD;
   }
+
+  return startMove(steps, rps,
+                   "{\"status\":\"success\", \"message\": \"Dispensed " + channelList(steps) + " steps at " + channelList(rps) + " rps\"}",
+                   "{\"status\":\"error\", \"message\": \"Failed to dispense " + channelList(steps) + " steps at " + channelList(rps) + " rps\"}");
+}
+
+String moveSteps(float channel_steps[], float speeds[]) {
+  int steps[NUM_CHANNELS];
+  float rps[NUM_CHANNELS];
+  for (int channel = 0; channel < NUM_CHANNELS; channel++) {
+    steps[channel] = round(channel_steps[channel]);
+    rps[channel] = speeds[channel] / (200 * STEPPER_PIPET_MICROSTEPS);
+  }
+
+  return startMove(steps, rps,
+                   "{\"status\":\"success\", \"message\": \"Moved " + channelList(steps) + " steps at " + channelList(rps) + " rps\"}",
+                   "{\"status\":\"error\", \"message\": \"Failed to move " + channelList(steps) + " steps at " + channelList(rps) + " rps\"}");
 }
 
 String eject() {
   return "{\"status\":\"success\",\"message\":\"Tip Ejected\"}";
 }
 
-bool moveStepper(int steps, float rps) {
-  if (PRETEND_FALSE) return false;
-  if (!USE_STEPPER_MOTOR) return true;
+// Starts every channel at once, loop() drives them simultaneously through serviceMove().
+// Returns the reply right away when there is nothing to drive, otherwise "" and the reply follows when the move ends
+String startMove(int steps[], float rps[], String reply, String failedReply) {
+  if (PRETEND_FALSE) return failedReply;
+  if (!USE_STEPPER_MOTOR) return reply;
 
-  stepper.setSpeedInRevolutionsPerSecond(rps);
-  stepper.setTargetPositionRelativeInSteps(steps);
+  for (int channel = 0; channel < NUM_CHANNELS; channel++) {
+    if (rps[channel] > 0) steppers[channel].setSpeedInRevolutionsPerSecond(rps[channel]);
+    steppers[channel].setTargetPositionRelativeInSteps(steps[channel]);
+  }
+  moveReply = reply;
+  moveFailedReply = failedReply;
+  moveActive = true;
+  return "";
+}
 
-  // Wait until movement is completed or a limit switch interrupt triggers
-  while (!stepper.motionComplete()) {
-    stepper.processMovement();
+// Called every loop() pass while a move is active, finishes it when every channel completed or a limit switch triggers
+void serviceMove() {
+  streamTelemetry();
 
-    // Check if a limit switch has been triggered via its interrupt
-    if (limitSwitchMinTriggered || limitSwitchMaxTriggered) {
-      stepper.emergencyStop();
-      // Clear the flags after stopping the motor
-      limitSwitchMinTriggered = false;
-      limitSwitchMaxTriggered = false;
-      return false; // Movement stopped due to limit switch
+  // Check if a limit switch has been triggered via its interrupt
+  if (limitSwitchMinTriggered || limitSwitchMaxTriggered) {
+    for (int channel = 0; channel < NUM_CHANNELS; channel++) {
+      steppers[channel].emergencyStop();
     }
+    // Clear the flags after stopping the motor
+    limitSwitchMinTriggered = false;
+    limitSwitchMaxTriggered = false;
+    finishMove(false); // Movement stopped due to limit switch
+    return;
+  }
+
+  for (int channel = 0; channel < NUM_CHANNELS; channel++) {
+    if (!steppers[channel].motionComplete()) return;
   }
+  finishMove(true);
+}
+
+void finishMove(bool success) {
+  moveActive = false;
+  if (programRunning) {
+    finishProgramStep(success);
+  } else {
+    sendReply(success ? moveReply : moveFailedReply);
+  }
+}
 
+// Streams a compact "T<ms>,<position>,<velocity>" sample of the first channel, rate limited by TELEMETRY_INTERVAL_MS
+void streamTelemetry() {
+  if (TELEMETRY_INTERVAL_MS == 0) return;
+  unsigned long now = millis();
+  if (now - lastTelemetryTime < TELEMETRY_INTERVAL_MS) return;
+  lastTelemetryTime = now;
+
+  char sample[48];
+  int length = snprintf(sample, sizeof(sample), "T%lu,%ld,%.1f", now,
+                        (long)steppers[0].getCurrentPositionInSteps(),
+                        steppers[0].getCurrentVelocityInStepsPerSecond());
+  // A full TX buffer would block loop() and stall the steppers, the sample is skipped instead
+  if (Serial.availableForWrite() < length + 2) return;
+  Serial.println(sample);
+}
+
+// Operand reads fail instead of reading past the uploaded program
+bool readProgramFloat(float &value) {
+  if (programCounter + (int)sizeof(value) > programLength) return false;
+  memcpy(&value, &program[programCounter], sizeof(value));
+  programCounter += sizeof(value);
+  return true;
+}
+
+bool readProgramInt(int32_t &value) {
+  if (programCounter + (int)sizeof(value) > programLength) return false;
+  memcpy(&value, &program[programCounter], sizeof(value));
+  programCounter += sizeof(value);
   return true;
-}
\ No newline at end of file
+}
+
+String truncatedProgram() {
+  return "{\"status\":\"error\",\"message\":\"Truncated operand at byte " + String(programCounter) + "\"}";
+}
+
+// Executes one instruction per loop() pass and streams "P<step>,<1|0>" completion events.
+// Moves and waits finish in later passes, loop() does not call this while a move is active
+void runProgramStep() {
+  if (programWaiting) {
+    if (millis() - programWaitStarted < programWaitMs) return;
+    programWaiting = false;
+    finishProgramStep(true);
+    return;
+  }
+  if (programCounter >= programLength) {
+    programRunning = false;
+    Serial.println("{\"status\":\"error\",\"message\":\"Program ended without end instruction\"}");
+    return;
+  }
+
+  uint8_t opcode = program[programCounter++];
+  String result = "{\"status\":\"success\"}";
+  if (opcode == OP_END) {
+    programRunning = false;
+    Serial.println("{\"status\":\"success\",\"message\":\"Program completed " + String(programStep) + " steps\"}");
+    return;
+  }
+  else if (opcode == OP_ASPIRATE || opcode == OP_DISPENSE) {
+    float volumes[NUM_CHANNELS];
+    float rates[NUM_CHANNELS];
+    float volume, rate;
+    if (!readProgramFloat(volume) || !readProgramFloat(rate)) {
+      result = truncatedProgram();
+    } else {
+      for (int channel = 0; channel < NUM_CHANNELS; channel++) {
+        volumes[channel] = volume;
+        rates[channel] = rate;
+      }
+      result = opcode == OP_ASPIRATE ? aspirate(volumes, rates) : dispense(volumes, rates);
+    }
+  }
+  else if (opcode == OP_MOVE) {
+    float steps[NUM_CHANNELS];
+    float speeds[NUM_CHANNELS];
+    int32_t channel_steps;
+    float speed;
+    if (!readProgramInt(channel_steps) || !readProgramFloat(speed)) {
+      result = truncatedProgram();
+    } else {
+      for (int channel = 0; channel < NUM_CHANNELS; channel++) {
+        steps[channel] = channel_steps;
+        speeds[channel] = speed;
+      }
+      result = moveSteps(steps, speeds);
+    }
+  }
+  else if (opcode == OP_EJECT) {
+    result = eject();
+  }
+  else if (opcode == OP_ZERO) {
+    result = "{\"status\":\"success\",\"message\":\"Robot zeroed\"}";
+  }
+  else if (opcode == OP_WAIT) {
+    int32_t waitMs;
+    if (!readProgramInt(waitMs)) {
+      result = truncatedProgram();
+    } else {
+      programWaitStarted = millis();
+      programWaitMs = waitMs;
+      programWaiting = true;
+      return;
+    }
+  }
+  else {
+    result = "{\"status\":\"error\",\"message\":\"Unknown opcode " + String(opcode) + "\"}";
+  }
+
+  // A started move reports the step from finishMove()
+  if (result.length() == 0) return;
+  finishProgramStep(result.indexOf("\"error\"") == -1);
+}
+
+void finishProgramStep(bool success) {
+  Serial.println("P" + String(programStep) + "," + String(success ? 1 : 0));
+  programStep++;
+  if (!success) {
+    programRunning = false;
+    Serial.println("{\"status\":\"error\",\"message\":\"Program failed at step " + String(programStep - 1) + "\"}");
+  }
+}
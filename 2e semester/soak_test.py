@@ -0,0 +1,240 @@
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+from time import monotonic, sleep
+from uuid import uuid4
+import numpy as np
+import requests
+from waitress import create_server
+from PythonServer_Package import RobotObject, RobotServer, SimulatedSerial
+try:
+    import psutil
+except ImportError:
+    psutil = None # Only Linux can be measured without it, through /proc
+
+# Drives RobotServer and a simulated device with mixed traffic for hours and watches for slow leaks
+# Resource usage is sampled over time, a trend above its threshold fails the run
+
+def rss_mb() -> float:
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    return float("nan")
+
+def open_fds() -> float:
+    # Handles on Windows, file descriptors elsewhere
+    if psutil is not None:
+        process = psutil.Process()
+        return process.num_handles() if sys.platform == "win32" else process.num_fds()
+    if os.path.isdir("/proc/self/fd"):
+        return len(os.listdir("/proc/self/fd"))
+    return float("nan")
+
+def handler_count() -> int:
+    # Handlers across every logger, stacked handlers show up here before they show up as file descriptors
+    loggers = [logging.getLogger()] + [logger for logger in logging.Logger.manager.loggerDict.values() if isinstance(logger, logging.Logger)]
+    return sum(len(logger.handlers) for logger in loggers)
+
+class SoakClient:
+    # One client thread sending a mix of commands, like a protocol script with a dashboard next to it
+    def __init__(self, url: str, client_id: str, seed: int, latencies: list, stats: dict, lock: threading.Lock) -> None:
+        self.url = url
+        self.client_id = client_id
+        self.rng = np.random.default_rng(seed)
+        self.latencies = latencies
+        self.stats = stats
+        self.lock = lock
+        self.session = requests.Session()
+        self.session.headers["X-Client-ID"] = client_id
+
+    def transfer(self) -> dict:
+        return {"volume": float(self.rng.uniform(1, 50)), "rate": float(self.rng.uniform(50, 200))}
+
+    def next_request(self) -> tuple[str, str, dict | None]:
+        choice = self.rng.random()
+        if choice < 0.22:
+            return "POST", "aspirate", self.transfer()
+        if choice < 0.44:
+            return "POST", "dispense", self.transfer()
+        if choice < 0.57:
+            return "GET", "request", None
+        if choice < 0.7:
+            return "GET", "ping", None
+        if choice < 0.8:
+            return "GET", "telemetry", None
+        if choice < 0.86:
+            return "GET", "queue_status", None
+        if choice < 0.9:
+            return "GET", "lease", None
+        if choice < 0.95:
+            return "POST", "set_safe_bounds", {"lower": -10000, "upper": 10000}
+        if choice < 0.98:
+            return "POST", "upload_program", {"steps": self.program()}
+        return "POST", "lease/acquire", {"duration": 10, "wait": float(self.rng.uniform(0, 2))}
+
+    def program(self) -> list:
+        volume = float(self.rng.uniform(1, 20))
+        return [["aspirate", volume, 100], ["wait", 0.1], ["dispense", volume, 100]]
+
+    def send(self, method: str, endpoint: str, payload: dict | None = None, token: str | None = None, key: str | None = None) -> requests.Response | None:
+        headers = {}
+        if token is not None:
+            headers["X-Lease-Token"] = token
+        if key is not None:
+            headers["Idempotency-Key"] = key
+        start = monotonic()
+        response = None
+        try:
+            response = self.session.request(method, f"{self.url}/{endpoint}", json=payload, headers=headers, timeout=30)
+            outcome = str(response.status_code)
+        except requests.exceptions.RequestException:
+            outcome = "exception"
+        latency = monotonic() - start
+        with self.lock:
+            self.latencies.append(latency)
+            self.stats[outcome] = self.stats.get(outcome, 0) + 1
+        return response
+
+    def send_mutating(self, method: str, endpoint: str, payload: dict | None = None, token: str | None = None) -> requests.Response | None:
+        # Every mutating command carries an Idempotency-Key, a few are sent twice like a client retry after a lost reply
+        key = uuid4().hex
+        response = self.send(method, endpoint, payload, token, key)
+        if self.rng.random() < 0.1:
+            response = self.send(method, endpoint, payload, token, key)
+        return response
+
+    def run_program(self, token: str | None = None) -> None:
+        response = self.send_mutating("POST", "upload_program", {"steps": self.program()}, token)
+        if response is not None and response.status_code == 200:
+            self.send_mutating("GET", "run_program", None, token)
+
+    def leased_session(self, response: requests.Response | None) -> None:
+        # Holds the robot for a few commands and a program, renews once and hands the lease back
+        if response is None or response.status_code != 200:
+            return
+        token = response.json()["token"]
+        for _ in range(int(self.rng.integers(1, 4))):
+            method, endpoint, payload = "POST", str(self.rng.choice(["aspirate", "dispense"])), self.transfer()
+            self.send_mutating(method, endpoint, payload, token)
+        self.send("POST", "lease/heartbeat", {"duration": 10}, token)
+        self.run_program(token)
+        if self.rng.random() < 0.95:
+            self.send("POST", "lease/release", None, token)
+        # The rest are abandoned and expire, like a script that crashed
+
+    def run(self, stop: threading.Event) -> None:
+        while not stop.is_set():
+            method, endpoint, payload = self.next_request()
+            if endpoint == "lease/acquire":
+                self.leased_session(self.send(method, endpoint, payload))
+            elif endpoint == "upload_program":
+                self.run_program()
+            elif method == "POST":
+                self.send_mutating(method, endpoint, payload)
+            else:
+                self.send(method, endpoint, payload)
+            sleep(float(self.rng.uniform(0, 0.02)))
+        self.session.close()
+
+def trend_per_hour(times: np.ndarray, values: np.ndarray) -> float:
+    if times.size < 3 or np.ptp(times) == 0:
+        return 0.0
+    return float(np.polyfit(times / 3600, values, 1)[0])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Soak test RobotServer with a simulated device and fail on resource growth")
+    parser.add_argument("--duration", type=float, default=4, help="Run time in hours")
+    parser.add_argument("--interval", type=float, default=30, help="Seconds between resource samples")
+    parser.add_argument("--warmup", type=float, default=0.1, help="Fraction of the run ignored for the trends, caches fill up first")
+    parser.add_argument("--clients", type=int, default=4, help="Number of client threads")
+    parser.add_argument("--port", type=int, default=5010)
+    parser.add_argument("--disconnect-rate", type=float, default=0.002, help="Chance per command that the device drops")
+    parser.add_argument("--malformed-rate", type=float, default=0.005, help="Chance per command of a truncated reply")
+    parser.add_argument("--relog-every", type=float, default=60, help="Seconds between setup_logging calls, 0 disables")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-rss-growth", type=float, default=5.0, help="MB per hour")
+    parser.add_argument("--max-fd-growth", type=float, default=1.0, help="File descriptors per hour")
+    parser.add_argument("--max-thread-growth", type=float, default=1.0, help="Threads per hour")
+    parser.add_argument("--max-handler-growth", type=float, default=0.5, help="Logging handlers per hour")
+    parser.add_argument("--max-p99-growth", type=float, default=50.0, help="p99 latency ms per hour")
+    args = parser.parse_args()
+
+    log_dir = tempfile.mkdtemp(prefix="soak_")
+    device = SimulatedSerial(disconnect_rate=args.disconnect_rate, malformed_rate=args.malformed_rate, seed=args.seed)
+    robot = RobotObject(device=device)
+
+    def quiet_logs() -> None:
+        # Injected faults log an error per command, those go to the log files only
+        for name in ("RobotObject", "Server"):
+            logger = logging.getLogger(name)
+            logger.setLevel(logging.WARNING)
+            for handler in logger.handlers:
+                if not isinstance(handler, logging.FileHandler):
+                    handler.setLevel(logging.CRITICAL + 1)
+    robot_server = RobotServer(robot, log_files_path=log_dir)
+    quiet_logs()
+    logging.getLogger("waitress").setLevel(logging.ERROR)
+
+    http_server = create_server(robot_server.app, host="127.0.0.1", port=args.port, threads=robot_server.http_threads())
+    threading.Thread(target=http_server.run, name="SoakServer", daemon=True).start()
+    url = f"http://127.0.0.1:{args.port}"
+
+    latencies: list[float] = []
+    stats: dict[str, int] = {}
+    lock = threading.Lock()
+    stop = threading.Event()
+    clients = [threading.Thread(target=SoakClient(url, f"soak-{index}", args.seed + index + 1, latencies, stats, lock).run,
+                                args=(stop,), name=f"SoakClient{index}", daemon=True) for index in range(args.clients)]
+    for client in clients:
+        client.start()
+
+    duration = args.duration * 3600
+    columns = ["time_s", "rss_mb", "fds", "threads", "handlers", "p50_ms", "p95_ms", "p99_ms", "requests"]
+    samples = []
+    start = monotonic()
+    last_relog = start
+    print(f"Soak test for {args.duration}h, logs in {log_dir}")
+    print(" ".join(f"{column:>9}" for column in columns))
+    while monotonic() - start < duration:
+        sleep(min(args.interval, max(duration - (monotonic() - start), 0)))
+        now = monotonic()
+        if args.relog_every > 0 and now - last_relog >= args.relog_every:
+            # Long running servers get their logging reconfigured, every call used to stack handlers
+            robot.setup_logging(log_dir)
+            robot_server.setup_logging(log_dir)
+            quiet_logs()
+            last_relog = now
+        with lock:
+            window = np.array(latencies) * 1000
+            latencies.clear()
+            total = sum(stats.values())
+        p50, p95, p99 = np.percentile(window, [50, 95, 99]) if window.size else (np.nan, np.nan, np.nan)
+        samples.append([now - start, rss_mb(), open_fds(), threading.active_count(), handler_count(), p50, p95, p99, total])
+        print(" ".join(f"{value:>9.1f}" for value in samples[-1]))
+
+    stop.set()
+    for client in clients:
+        client.join(timeout=35)
+    http_server.close()
+
+    data = np.array(samples, dtype=np.float64).reshape(-1, len(columns))
+    print(f"Responses: {dict(sorted(stats.items()))}")
+    steady = data[data[:, 0] >= args.warmup * duration]
+    limits = {"rss_mb": args.max_rss_growth, "fds": args.max_fd_growth, "threads": args.max_thread_growth,
+              "handlers": args.max_handler_growth, "p99_ms": args.max_p99_growth}
+    failed = False
+    for column, limit in limits.items():
+        values = steady[:, columns.index(column)]
+        valid = ~np.isnan(values)
+        trend = trend_per_hour(steady[valid, 0], values[valid])
+        status = "FAIL" if trend > limit else "ok"
+        failed |= trend > limit
+        print(f"{column:<9} trend {trend:+10.2f}/h  limit {limit:+8.2f}/h  {status}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,18 @@
+import numpy as np
+from PythonServer_Package import RobotObject, SimulatedSerial
+from PythonServer_Package.command_history import OP_RUN
+
+def test_program_rows_follow_the_run_row_in_time_order(tmp_path):
+    robot = RobotObject(device=SimulatedSerial(), history_path=str(tmp_path / "history"))
+    robot.setup_logging(str(tmp_path))
+    robot.connect_serial()
+    robot.upload_program([["aspirate", 10, 50], ["wait", 0.1], ["dispense", 10, 50]], print_confirmation=False)
+    robot.run_program(print_confirmation=False)
+
+    records = robot.history.query()
+    assert np.all(np.diff(records["timestamp"]) >= 0)
+    run = int(np.flatnonzero(records["opcode"] == OP_RUN)[0])
+    assert len(records["opcode"]) - run - 1 == 3
+    at_run = robot.history.query(start=records["timestamp"][run], end=records["timestamp"][run])
+    assert at_run["opcode"][0] == OP_RUN
+    robot.history.close()
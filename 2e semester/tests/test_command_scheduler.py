@@ -0,0 +1,25 @@
+import pytest
+from PythonServer_Package.command_scheduler import QueueFullError, SchedulerCore
+
+class Command:
+    def __init__(self, name: str, estimated_duration: float) -> None:
+        self.name = name
+        self.estimated_duration = estimated_duration
+
+def test_core_admits_round_robin_on_any_clock():
+    core = SchedulerCore(max_queue_depth=4, max_client_depth=2)
+    for name in ("a1", "a2"):
+        core.admit("A", Command(name, 1.0), now=0.0)
+    core.admit("B", Command("b1", 2.0), now=0.0)
+    with pytest.raises(QueueFullError) as rejected:
+        core.admit("A", Command("a3", 1.0), now=0.0)
+    assert rejected.value.status_code == 429
+
+    assert core.next_command(now=10.0).name == "a1"
+    assert core.queue_wait(now=10.5, client_id="A") == pytest.approx(0.5 + 2.0 + 1.0)
+    core.finish(now=11.5)
+    assert core.overhead == pytest.approx(0.2 * 0.5)
+    assert core.next_command(now=12.0).name == "b1"
+    core.finish(now=14.0)
+    assert core.next_command(now=14.0).name == "a2"
+    assert core.completed == 2 and core.queue_depth == 0
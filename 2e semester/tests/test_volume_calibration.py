@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from PythonServer_Package import RobotObject, SimulatedSerial
+from PythonServer_Package.volume_calibration import CalibrationProfile, VolumeLookupTable
+
+def profile_up_to_200ul() -> CalibrationProfile:
+    return CalibrationProfile([0, 50, 200], [0, 48, 196])
+
+def test_table_rejects_max_volume_above_calibrated_range():
+    with pytest.raises(Exception, match="only covers"):
+        VolumeLookupTable(profile_up_to_200ul(), steps_per_ul=100, max_volume=1000)
+
+def test_table_rejects_volumes_above_calibrated_range():
+    table = VolumeLookupTable(profile_up_to_200ul(), steps_per_ul=100)
+    assert table.max_volume == 196
+    assert table.volume_to_steps([196])[0] == 20000
+    for volume in (200, 500, 900):
+        with pytest.raises(Exception, match="outside of the calibrated range"):
+            table.volume_to_steps([volume])
+
+def test_robot_does_not_move_or_book_volume_out_of_range(tmp_path):
+    robot = RobotObject(device=SimulatedSerial())
+    robot.setup_logging(str(tmp_path))
+    robot.connect_serial()
+    robot.set_calibration_profile(profile_up_to_200ul(), print_confirmation=False)
+    with pytest.raises(Exception, match="outside of the calibrated range"):
+        robot.aspirate_pipette(500, 100, print_confirmation=False)
+    assert robot.current_volume == 0
+    assert np.all(robot.device.positions == 0)
+    assert robot.timeout == 60
+
+def test_timeout_is_restored_when_the_move_fails(tmp_path):
+    robot = RobotObject(device=SimulatedSerial())
+    robot.setup_logging(str(tmp_path))
+    robot.connect_serial()
+    robot.device.disconnect_rate = 1.0
+    with pytest.raises(Exception):
+        robot.aspirate_pipette(10, 100, print_confirmation=False)
+    assert robot.timeout == 60